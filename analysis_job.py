@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+
+# ---------------------------------------------------------
+# 화면을 막지 않는 백그라운드 분석 작업
+# 작업 함수는 report(진행률 0~1, 메시지)를 호출하며 진행 상황을 알리고,
+# 취소되면 report 호출 시점에 AnalysisCancelled가 발생해 작업이 멈춘다.
+# ---------------------------------------------------------
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+class AnalysisJob:
+    def __init__(self, target, key=None):
+        # target(report) -> 결과. key는 결과가 어떤 입력/설정으로 계산됐는지 표시 (화면에서 비교용)
+        self.key = key
+        self.progress = 0.0
+        self.message = '대기 중'
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.started_at = None
+        self.elapsed = 0.0
+        self._target = target
+        self._cancel_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _report(self, progress, message=None):
+        if self._cancel_event.is_set():
+            raise AnalysisCancelled()
+        self.progress = min(max(float(progress), 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+    def _run(self):
+        try:
+            self.result = self._target(self._report)
+        except AnalysisCancelled:
+            self.cancelled = True
+        except Exception as e:
+            self.error = e
+        finally:
+            self.elapsed = time.perf_counter() - self.started_at
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        # 다음 진행률 보고 시점(청크 경계)에 멈춘다
+        self._cancel_event.set()
+
+    @property
+    def done(self):
+        return self.started_at is not None and not self._thread.is_alive()
+
+
+def chunk_progress(report, total_rows, start, end, message):
+    # iter_clean_chunks의 progress(읽은 행 수)를 전체 진행률 구간 [start, end]에 맞춰 report로 전달
+    def progress(rows_read):
+        fraction = rows_read / total_rows if total_rows else 0.5
+        report(start + (end - start) * min(fraction, 1.0), f'{message} ({rows_read:,}행)')
+    return progress
+
+
+class ResultCache:
+    # 끝난 작업 결과를 키별로 보관 (여러 사용자 공유). max_entries개를 넘으면 가장 오래 안 쓴 것부터,
+    # 넣은 지 ttl초가 지나면 제거 (st.cache_data와 같은 기준)
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [k for k, (stored_at, _) in self._items.items() if now - stored_at > self.ttl]:
+            del self._items[key]
+
+    def get(self, key):
+        with self._lock:
+            self._expire()
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._expire()
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
@@ -0,0 +1,292 @@
+import argparse
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import export
+from preprocess import LOCAL_TZ
+from cost_core import (
+    RATES_DB, VAT_RATE, BANDS_PER_VERSION, shift_rate_table,
+    calculate_tou_cost_photo, calculate_tou_cost_segment, calculate_tou_cost_batch,
+    decompose_band_minutes, price_band_minutes, simulate_load_shift,
+    load_sessions, price_sessions, summarize_sessions, monthly_billing, build_demand_profile, billing_months,
+)
+
+# ---------------------------------------------------------
+# 요금 엔진 벤치마크 + 기준 엔진(calculate_tou_cost_photo)과의 무작위 동등성 검사
+#   python bench_cost.py bench --sizes 10000 100000 1000000
+#   python bench_cost.py check --cases 300 --seed 0
+# 속도 개선 작업 후에는 check를 돌려 청구 금액이 바뀌지 않았는지 확인 (test_pricing_equivalence.py가 pytest로도 실행)
+# ---------------------------------------------------------
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+XLSX_BENCH_MAX_ROWS = 100_000 # xlsx 내보내기는 느려서 이 크기까지만 측정
+CHECK_TOLERANCE = 1e-6 # 상대 오차 (분 단위 누적 단가의 부동소수점 합 차이)
+
+
+def make_sessions(n, seed=0, mean_minutes=90, months=range(1, 13), weekend_share=2 / 7, year=2024):
+    # 충전 이력 파일 형태의 합성 데이터. 충전 시간은 로그정규 분포(평균 mean_minutes분),
+    # 시작 월은 months에서 고르게, 주말 비율은 weekend_share
+    rng = np.random.default_rng(seed)
+    months = np.asarray(list(months))
+    month = rng.choice(months, n)
+    first = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': 1}))
+    days_in_month = first.dt.days_in_month.to_numpy()
+    day = rng.integers(0, days_in_month)
+    dates = first + pd.to_timedelta(day, unit='D')
+
+    # 주말/평일 비율 맞추기: 원하는 쪽이 아니면 같은 달 안에서 가까운 날로 옮긴다
+    want_weekend = rng.random(n) < weekend_share
+    is_weekend = dates.dt.weekday.to_numpy() >= 5
+    for _ in range(7):
+        wrong = want_weekend != is_weekend
+        if not wrong.any():
+            break
+        day = np.where(wrong, (day + 1) % days_in_month, day)
+        dates = first + pd.to_timedelta(day, unit='D')
+        is_weekend = dates.dt.weekday.to_numpy() >= 5
+
+    starts = dates + pd.to_timedelta(rng.integers(0, 86_400, n), unit='s')
+    sigma = 0.8
+    minutes = rng.lognormal(np.log(mean_minutes) - sigma ** 2 / 2, sigma, n).clip(1, 24 * 60)
+    ends = starts + pd.to_timedelta(np.round(minutes * 60), unit='s')
+    kwh = (minutes / 60 * rng.uniform(7, 100, n)).round(2)
+    return pd.DataFrame({
+        '충전시작일시': starts.dt.strftime('%Y-%m-%d %H:%M:%S'),
+        '충전종료일시': ends.dt.strftime('%Y-%m-%d %H:%M:%S'),
+        '충전량(kWh)': kwh,
+        '판매단가': rng.choice([290.0, 310.0, 347.2], n),
+    })
+
+
+# ---------------------------------------------------------
+# 벤치마크
+# ---------------------------------------------------------
+def timed(results, size, stage, func, *args, **kwargs):
+    tracemalloc.reset_peak()
+    t0 = time.perf_counter()
+    value = func(*args, **kwargs)
+    results.append({
+        '행 수': size, '단계': stage, '시간(초)': time.perf_counter() - t0,
+        '최대 메모리(MB)': tracemalloc.get_traced_memory()[1] / 1024 ** 2,
+    })
+    return value
+
+
+def run_benchmark(sizes, seed=0, trace_memory=False):
+    # trace_memory를 켜면 단계별 최대 메모리도 재지만, tracemalloc 때문에 시간은 몇 배 느려진다
+    rates = RATES_DB['저압']['tou']
+    tax_rate = VAT_RATE + 0.027
+    results = []
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        for size in sizes:
+            raw = make_sessions(size, seed)
+            csv_bytes = raw.to_csv(index=False).encode()
+            parquet_bytes = export.export_file(raw, 'parquet')
+            cols = ('충전시작일시', '충전종료일시', '충전량(kWh)', '판매단가', 3, 0.5)
+
+            timed(results, size, '읽기+전처리 (CSV)', load_sessions, csv_bytes, 'bench.csv', *cols)
+            sessions, band_minutes = timed(results, size, '읽기+전처리 (Parquet)', load_sessions, parquet_bytes, 'bench.parquet', *cols)
+            timed(results, size, '요금 계산 (prefix sum)', calculate_tou_cost_batch,
+                  sessions['분석_시작'], sessions['분석_종료'], sessions['분석_충전량'], rates)
+            priced = timed(results, size, '요금 계산 (구간 분해 행렬)', price_sessions,
+                           sessions, band_minutes, rates, 5.0, 14.0, tax_rate)
+            n_months = max(len(billing_months(priced['분석_시작'])), 1)
+            timed(results, size, '집계 (요약)', summarize_sessions, priced, 239_000 * n_months)
+            timed(results, size, '집계 (월별 청구)', monthly_billing, priced, band_minutes, rates, 239_000, 14.0, tax_rate)
+            timed(results, size, '집계 (15분 수요)', build_demand_profile,
+                  priced['분석_시작'], priced['분석_종료'], priced['매입_전력량'])
+            timed(results, size, '부하 이동 (최대 4시간)', simulate_load_shift,
+                  priced['분석_시작'], priced['분석_종료'], priced['매입_전력량'], rates, 240)
+            for kind in ('csv', 'parquet', 'xlsx'):
+                if kind == 'xlsx' and size > XLSX_BENCH_MAX_ROWS:
+                    continue
+                timed(results, size, f'내보내기 ({kind})', export.export_file, priced, kind)
+            print(f'{size:,}행 완료', file=sys.stderr)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    table = pd.DataFrame(results)
+    if not trace_memory:
+        table = table.drop(columns='최대 메모리(MB)')
+    return table
+
+
+# ---------------------------------------------------------
+# 동등성 검사
+# ---------------------------------------------------------
+def random_check_sessions(n, seed):
+    # 경계 상황 위주의 무작위 세션: 초 단위 시작, 자정/월/연 경계, 0분·역전·NaT, 여러 날에 걸친 충전
+    rng = np.random.default_rng(seed)
+    anchors = pd.to_datetime(['2023-12-31 23:00', '2024-02-29 22:30', '2024-05-31 23:59', '2024-08-31 20:00',
+                              '2024-10-31 21:45', '2024-03-09 07:30', '2025-01-01 00:00', '2024-06-15 10:59'])
+    starts = anchors[rng.integers(0, len(anchors), n)] + pd.to_timedelta(rng.integers(-3 * 86_400, 3 * 86_400, n), unit='s')
+    kind = rng.random(n)
+    seconds = np.where(kind < 0.6, rng.integers(60, 6 * 3600, n),          # 보통 충전
+              np.where(kind < 0.8, rng.integers(6 * 3600, 3 * 86_400, n),   # 여러 날
+              np.where(kind < 0.9, rng.integers(0, 120, n),                 # 0~2분
+                       -rng.integers(1, 3600, n))))                          # 역전
+    ends = pd.Series(starts + pd.to_timedelta(seconds, unit='s'))
+    starts = pd.Series(starts)
+    missing = rng.random(n) < 0.02
+    starts[missing] = pd.NaT
+    kwh = rng.uniform(0, 80, n).round(3)
+    return starts, ends, kwh
+
+
+def _text_times(times, kind):
+    # 충전 이력 파일에서 볼 수 있는 날짜 문자열 형식으로 변환 (NaT는 빈 칸)
+    if kind == 'iso':
+        return times.dt.strftime('%Y-%m-%d %H:%M:%S')
+    if kind == 'slash':
+        return times.dt.strftime('%Y/%m/%d %H:%M:%S')
+    if kind == 'ampm':
+        return times.dt.strftime('%Y.%m.%d %p %I:%M:%S').str.replace('AM', '오전').str.replace('PM', '오후')
+    if kind == 'offset':
+        return times.dt.tz_localize(LOCAL_TZ).map(lambda t: t.isoformat() if pd.notna(t) else None)
+    if kind == 'utc':
+        return times.dt.tz_localize(LOCAL_TZ).dt.tz_convert('UTC').dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    raise ValueError(kind)
+
+
+def file_check_cases(starts, ends, kwh):
+    # 같은 세션을 여러 파일 형식/날짜 표기로 저장 -> load_sessions (ingest 읽기 + preprocess 파싱 + 구간 분해)
+    # 반환: [(설명, 세션, 구간 분해 행렬)]
+    cases = []
+    for kind in ('iso', 'slash', 'ampm', 'offset', 'utc'):
+        frame = pd.DataFrame({'시작': _text_times(starts, kind), '종료': _text_times(ends, kind), '충전량': kwh})
+        cases.append((f'CSV {kind}', frame.to_csv(index=False).encode(), 'check.csv'))
+        if kind == 'ampm':
+            cases.append((f'xlsx {kind}', export.export_file(frame, 'xlsx'), 'check.xlsx'))
+    utc = pd.DataFrame({'시작': starts.dt.tz_localize(LOCAL_TZ).dt.tz_convert('UTC'),
+                        '종료': ends.dt.tz_localize(LOCAL_TZ).dt.tz_convert('UTC'), '충전량': kwh})
+    cases.append(('Parquet UTC 시각', export.export_file(utc, 'parquet'), 'check.parquet'))
+    return [(label, *load_sessions(data, name, '시작', '종료', '충전량', None, 0, 0, holidays=()))
+            for label, data, name in cases]
+
+
+def _mismatches(name, expected, actual, report):
+    expected, actual = np.asarray(expected, dtype=float), np.asarray(actual, dtype=float)
+    bad = np.abs(actual - expected) > CHECK_TOLERANCE * np.maximum(np.abs(expected), 1.0)
+    for i in np.flatnonzero(bad)[:5]:
+        report.append(f'{name} #{i}: 기준 {float(expected[i])!r} / 결과 {float(actual[i])!r}')
+    return int(bad.sum())
+
+
+def run_equivalence_check(cases=300, seed=0):
+    # 반환: 불일치 설명 목록 (비어 있으면 통과)
+    report = []
+    starts, ends, kwh = random_check_sessions(cases, seed)
+    # 파일 경로는 시간이 없거나 역전된 세션을 걸러낸다 (최소 시간/충전량 0)
+    loadable = (starts.notna() & ends.notna() & (ends >= starts)).to_numpy()
+    loaded = file_check_cases(starts, ends, kwh)
+    for label, sessions, _ in loaded:
+        if len(sessions) != loadable.sum():
+            report.append(f'{label}: 불러온 세션 {len(sessions)}건 != {int(loadable.sum())}건')
+            continue
+        # 파싱한 시각은 시간대 없는 현지 시각이어야 한다 (월별 청구/기간 필터가 .dt로 바로 씀)
+        for col, expected in (('분석_시작', starts), ('분석_종료', ends)):
+            parsed = sessions[col]
+            if parsed.dt.tz is not None or (parsed.to_numpy('datetime64[ns]') != expected[loadable].to_numpy('datetime64[ns]')).any():
+                report.append(f'{label}: {col} 값이 원래 현지 시각과 다름')
+    for contract, tariff in RATES_DB.items():
+        rates = tariff['tou']
+        ref = [calculate_tou_cost_photo(s, e, k, rates) for s, e, k in zip(starts, ends, kwh)]
+        ref_cost, ref_rate = np.array([r[0] for r in ref]), np.array([r[1] for r in ref])
+
+        # 기준 엔진은 공휴일을 모르므로 holidays=()로 비교
+        seg = [calculate_tou_cost_segment(s, e, k, rates, holidays=()) for s, e, k in zip(starts, ends, kwh)]
+        _mismatches(f'{contract} segment 요금', ref_cost, [r[0] for r in seg], report)
+        _mismatches(f'{contract} segment 단가', ref_rate, [r[1] for r in seg], report)
+
+        batch_cost, batch_rate = calculate_tou_cost_batch(starts, ends, kwh, rates, holidays=())
+        _mismatches(f'{contract} batch 요금', ref_cost, batch_cost, report)
+        _mismatches(f'{contract} batch 단가', ref_rate, batch_rate, report)
+
+        band_minutes = decompose_band_minutes(starts, ends, holidays=())
+        band_cost, band_rate = price_band_minutes(band_minutes, kwh, rates)
+        _mismatches(f'{contract} 구간분해 요금', ref_cost, band_cost, report)
+        _mismatches(f'{contract} 구간분해 단가', ref_rate, band_rate, report)
+
+        _, no_shift_cost = simulate_load_shift(starts, ends, kwh, rates, 0, holidays=())
+        _mismatches(f'{contract} 부하이동(지연 0) 요금', ref_cost, no_shift_cost, report)
+
+        # 시간대가 있는 시각 (UTC로 저장된 데이터)도 현지 시각 기준으로 같은 요금
+        utc_starts = starts.dt.tz_localize(LOCAL_TZ).dt.tz_convert('UTC')
+        utc_ends = ends.dt.tz_localize(LOCAL_TZ).dt.tz_convert('UTC')
+        utc_cost, _ = calculate_tou_cost_batch(utc_starts, utc_ends, kwh, rates, holidays=())
+        _mismatches(f'{contract} batch 요금 (UTC 시각)', ref_cost, utc_cost, report)
+        utc_band_cost, _ = price_band_minutes(decompose_band_minutes(utc_starts, utc_ends, holidays=()), kwh, rates)
+        _mismatches(f'{contract} 구간분해 요금 (UTC 시각)', ref_cost, utc_band_cost, report)
+        _, utc_shift_cost = simulate_load_shift(utc_starts, utc_ends, kwh, rates, 0, holidays=())
+        _mismatches(f'{contract} 부하이동(지연 0) 요금 (UTC 시각)', ref_cost, utc_shift_cost, report)
+
+        for label, sessions, file_band_minutes in loaded:
+            if len(sessions) == loadable.sum():
+                file_cost, _ = price_band_minutes(file_band_minutes, sessions['분석_충전량'], rates)
+                _mismatches(f'{contract} {label} 요금', ref_cost[loadable], file_cost, report)
+
+        # 공휴일/요금 개정은 빠른 엔진끼리 비교
+        revised = [rates, shift_rate_table(rates, 7.5)]
+        version_dates = ('2024-07-01',)
+        seg_h = [calculate_tou_cost_segment(s, e, k, rates) for s, e, k in zip(starts, ends, kwh)]
+        batch_h, _ = calculate_tou_cost_batch(starts, ends, kwh, rates)
+        band_h, _ = price_band_minutes(decompose_band_minutes(starts, ends), kwh, rates)
+        _mismatches(f'{contract} 공휴일 batch', [r[0] for r in seg_h], batch_h, report)
+        _mismatches(f'{contract} 공휴일 구간분해', [r[0] for r in seg_h], band_h, report)
+        batch_v, _ = calculate_tou_cost_batch(starts, ends, kwh, revised, version_dates=version_dates)
+        band_v, _ = price_band_minutes(decompose_band_minutes(starts, ends, version_dates=version_dates), kwh, revised)
+        _mismatches(f'{contract} 요금개정 구간분해', batch_v, band_v, report)
+
+        if band_minutes.shape[1] != BANDS_PER_VERSION:
+            report.append(f'{contract} 구간분해 열 수 {band_minutes.shape[1]} != {BANDS_PER_VERSION}')
+        if (band_minutes.sum(axis=1) != np.array([
+                max(int((e - s).total_seconds() // 60), 0) if pd.notna(s) and pd.notna(e) else 0
+                for s, e in zip(starts, ends)])).any():
+            report.append(f'{contract} 구간분해 분 수 합계가 충전 시간과 다름')
+    return report
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='요금 엔진 벤치마크와 기준 엔진 동등성 검사')
+    sub = parser.add_subparsers(dest='command', required=True)
+    bench = sub.add_parser('bench', help='합성 데이터로 단계별 처리 시간 측정')
+    bench.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='세션 수 목록')
+    bench.add_argument('--seed', type=int, default=0)
+    bench.add_argument('--memory', action='store_true', help='단계별 최대 메모리도 측정 (느려짐)')
+    bench.add_argument('-o', '--output', default=None, help='결과 CSV 파일')
+    check = sub.add_parser('check', help='빠른 엔진이 calculate_tou_cost_photo와 같은 요금을 내는지 검사')
+    check.add_argument('--cases', type=int, default=300, help='무작위 세션 수')
+    check.add_argument('--seed', type=int, default=0)
+    check.add_argument('--rounds', type=int, default=1, help='시드를 바꿔 반복할 횟수')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'bench':
+        table = run_benchmark(args.sizes, args.seed, args.memory)
+        summary = table.pivot(index='단계', columns='행 수', values='시간(초)').reindex(table['단계'].unique())
+        print(summary.round(3).to_string())
+        if args.output:
+            table.to_csv(args.output, index=False, encoding='utf-8-sig')
+        return 0
+
+    failures = []
+    for r in range(args.rounds):
+        failures += run_equivalence_check(args.cases, args.seed + r)
+    if failures:
+        print('\n'.join(failures), file=sys.stderr)
+        print(f'불일치 {len(failures)}건', file=sys.stderr)
+        return 1
+    print(f'통과: {args.cases * args.rounds:,}개 세션 x {len(RATES_DB)}개 요금제')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
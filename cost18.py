@@ -1,112 +1,259 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import altair as alt
-from datetime import timedelta
-import io
-import re
+import logging
+from functools import partial
+from datetime import date
 
-# ---------------------------------------------------------
-# 1. 데이터베이스: [선택 II] 요금제 확정
-# ---------------------------------------------------------
-RATES_DB = {
-    '고압': {
-        'base_cost': 2580,
-        'tou': {
-            '봄가을': {'경부하': 80.2, '중간부하': 91.0,  '최대부하': 94.9},
-            '여름':   {'경부하': 78.2, '중간부하': 113.0, '최대부하': 198.6},
-            '겨울':   {'경부하': 95.2, '중간부하': 105.5, '최대부하': 172.4}
-        }
-    },
-    '저압': {
-        'base_cost': 2390,
-        'tou': {
-            '봄가을': {'경부하': 85.4, '중간부하': 97.2,  '최대부하': 102.1},
-            '여름':   {'경부하': 83.1, '중간부하': 140.0, '최대부하': 270.8},
-            '겨울':   {'경부하': 105.8, '중간부하': 126.7, '최대부하': 227.0}
-        }
-    }
-}
+from cost_core import (
+    RATES_DB, LOAD_NAMES, LOAD_COLORS, VAT_RATE, KR_HOLIDAYS, shift_rate_table,
+    match_column, detect_column, file_digest, track_peak_memory, StageLog, STAGE_LOGGER,
+    default_scenarios, compare_scenarios, load_sessions, price_sessions, summarize_sessions,
+    build_demand_profile, peak_demand_table, billed_monthly_peaks, optimize_contract_power, billing_months, monthly_billing,
+    hourly_energy_table, what_if_grid, simulate_load_shift, decompose_band_minutes, band_kwh_totals,
+    BANDS_PER_VERSION,
+)
+import ingest
+import session_store
+import export
+from analysis_job import AnalysisJob, ResultCache, chunk_progress
 
-SEASONS = {
-    3:'봄가을', 4:'봄가을', 5:'봄가을',
-    6:'여름', 7:'여름', 8:'여름',
-    9:'봄가을', 10:'봄가을',
-    11:'겨울', 12:'겨울', 1:'겨울', 2:'겨울'
+# 업로드 캐시: 여러 사용자가 서버를 같이 쓰므로 개수/시간 제한으로 오래된 항목부터 제거
+CACHE_MAX_ENTRIES = 8
+CACHE_TTL_SECONDS = 60 * 60
+DETAIL_PAGE_SIZES = [50, 100, 500, 1000]
+DETAIL_COLUMNS = {
+    '분석_시작': '충전시작', '판매_전력량': '판매량(kWh)', '요금표단가': '한전단가(표준)',
+    '매출액': '매출', '변동비_세후_총액': '실제원가총액(세금포함)',
 }
+ANALYSIS_POLL_SECONDS = 0.5
 
-# 시간대 정의
-TABLE_SPRING_SUMMER = ([0]*8 + [1]*3 + [2]*1 + [1]*1 + [2]*5 + [1]*4 + [0]*2)
-TABLE_WINTER = ([0]*8 + [1]*1 + [2]*3 + [1]*4 + [2]*3 + [1]*3 + [0]*2)
+# 단계별 계측 로그는 서버 표준 에러로 (JSON 한 줄씩). 이미 설정돼 있으면 그대로 사용
+if not STAGE_LOGGER.handlers:
+    _stage_handler = logging.StreamHandler()
+    _stage_handler.setFormatter(logging.Formatter('%(message)s'))
+    STAGE_LOGGER.addHandler(_stage_handler)
+    STAGE_LOGGER.setLevel(logging.INFO)
 
-TIME_TABLE_MAP = {
-    '봄가을': TABLE_SPRING_SUMMER,
-    '여름':   TABLE_SPRING_SUMMER,
-    '겨울':   TABLE_WINTER
-}
+# ---------------------------------------------------------
+# 1. 캐시 / 백그라운드 불러오기 (요금 계산/집계 함수는 cost_core.py)
+# ---------------------------------------------------------
+# 파일 내용 해시를 키로 사용 (밑줄 인자는 해시 대상에서 제외)
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+def cached_preview(file_hash, name, _data):
+    return ingest.read_preview(_data, name)
 
-LOAD_NAMES = ['경부하', '중간부하', '최대부하']
-LOAD_COLORS = {'경부하': '#2ecc71', '중간부하': '#f1c40f', '최대부하': '#e74c3c'} 
-VAT_RATE = 0.10
+@st.cache_resource
+def analysis_results():
+    # 불러오기 결과 보관소 (모든 사용자 공유, 개수/시간 제한). 같은 파일/설정이면 다시 읽지 않고 재사용
+    # 세션 상태에는 키만 둔다 (사용자마다 전체 세션을 들고 있지 않도록)
+    return ResultCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+
+def analysis_result_key(load_key, store_dir):
+    # 저장소를 쓰면 저장소 상태까지 키에 넣는다 (다른 사용자가 파일을 추가했으면 다시 분석)
+    return load_key + (session_store.store_version(store_dir) if store_dir is not None else None,)
+
+def run_session_load(data, name, file_hash, start_col, end_col, kwh_col, price_col, min_minutes, min_kwh,
+                     holidays, version_dates, store_dir, trace_memory, report):
+    # 백그라운드 작업 본문 (st.* 호출 금지). store_dir이 있으면 누적 저장소 경유
+    # trace_memory는 진단 정보를 켰을 때만 (tracemalloc이 불러오기를 크게 늦춘다)
+    total_rows = ingest.estimate_rows(data, name)
+    store_rows = None
+    stages = StageLog(file=name, file_mb=round(len(data) / 1024 ** 2, 2))
+    with track_peak_memory(trace_memory) as mem_stats:
+        report(0.0, '파일 읽는 중')
+        if store_dir is not None:
+            # 새 세션만 저장소에 추가한 뒤, 저장된 전체 세션으로 분석
+            store_rows = session_store.add_file(
+                store_dir, data, name, file_hash, start_col, end_col, kwh_col, price_col, holidays, version_dates,
+                progress=chunk_progress(report, total_rows, 0.0, 0.8, '신규 세션 저장 중'), stages=stages
+            )
+            report(0.8, '저장소 불러오는 중')
+            sessions, band_minutes = session_store.load_store(store_dir, min_minutes, min_kwh, holidays, version_dates,
+                                                              stages=stages)
+        else:
+            sessions, band_minutes = load_sessions(
+                data, name, start_col, end_col, kwh_col, price_col, min_minutes, min_kwh, holidays, version_dates,
+                progress=chunk_progress(report, total_rows, 0.0, 0.95, '전처리/구간 분해 중'), stages=stages
+            )
+        report(1.0, '완료')
+    return {'sessions': sessions, 'band_minutes': band_minutes, 'store_rows': store_rows, 'peak_mb': mem_stats['peak_mb'],
+            'stages': stages, 'store_version': session_store.store_version(store_dir) if store_dir is not None else None}
 
 # ---------------------------------------------------------
-# 2. 함수 정의
+# 2. 화면 조각 (슬라이더를 움직이면 이 부분만 다시 실행)
 # ---------------------------------------------------------
-def clean_number(value):
-    if pd.isna(value): return 0
-    s_val = str(value)
-    clean_val = re.sub(r'[^\d.]', '', s_val)
-    try: return float(clean_val)
-    except ValueError: return 0
-
-def find_column(columns, keywords):
-    for col in columns:
-        for key in keywords:
-            if key in str(col).replace(" ", ""): return col
-    return columns[0] if len(columns) > 0 else None
-
-def get_load_type_idx(month, hour, weekday):
-    season = SEASONS[month]
-    base_idx = TIME_TABLE_MAP[season][hour]
-    if weekday == 6: return 0 # 일요일
-    if weekday == 5 and base_idx == 2: return 1 # 토요일
-    return base_idx
-
-def get_load_type_name(month, hour, weekday=0):
-    idx = get_load_type_idx(month, hour, weekday)
-    return LOAD_NAMES[idx]
-
-def calculate_tou_cost_photo(start, end, kwh, rate_table):
-    if pd.isnull(start) or pd.isnull(end): return 0, 0
-    diff = end - start
-    total_minutes = int(diff.total_seconds() / 60)
-    if total_minutes <= 0: return 0, 0
-    
-    kwh_per_min = kwh / total_minutes
-    cost = 0
-    
-    # 순수 요금표 단가 계산용
-    tou_rate_accum = 0 
-    
-    curr = start
-    for _ in range(total_minutes):
-        month = curr.month
-        hour = curr.hour
-        weekday = curr.weekday()
-        
-        idx = get_load_type_idx(month, hour, weekday)
-        load_type = LOAD_NAMES[idx]
-        season = SEASONS[month]
-        
-        price = rate_table[season][load_type]
-        
-        cost += price * kwh_per_min
-        tou_rate_accum += price # 단가 누적
-        curr += timedelta(minutes=1)
-        
-    # 평균 적용 단가 (순수 요금표 기준)
-    avg_tou_rate = tou_rate_accum / total_minutes
-    
-    return cost, avg_tou_rate
+@st.fragment(run_every=ANALYSIS_POLL_SECONDS)
+def analysis_progress(job):
+    # 작업이 도는 동안 이 조각만 주기적으로 다시 그린다. 끝나면 전체를 다시 실행해 결과 표시
+    if job.done:
+        st.rerun()
+    st.progress(job.progress, text=f"⏳ {job.message}")
+    if st.button("⏹ 분석 취소"):
+        job.cancel()
+
+@st.fragment
+def contract_power_panel(monthly_peaks, base_rate, tax_rate, current_power):
+    st.subheader("🎯 계약 전력 최적화")
+    o1, o2 = st.columns(2)
+    penalty_multiplier = o1.slider("초과 부가금 배수 (기본요금 단가 대비)", 0.0, 5.0, 1.5, 0.1,
+                                   help="계약전력을 넘긴 kW에 기본요금 단가의 몇 배를 물리는지 (계약 약관 확인)")
+    upper = max(float(np.max(monthly_peaks)) * 1.5, current_power * 1.5, 1.0)
+    search = o2.slider("탐색 범위 (kW)", 0.0, upper, (0.0, upper), 1.0)
+
+    sweep = optimize_contract_power(monthly_peaks, base_rate, tax_rate, penalty_multiplier,
+                                    np.arange(search[0], search[1] + 1))
+    best = sweep.loc[sweep['합계'].idxmin()]
+    current = optimize_contract_power(monthly_peaks, base_rate, tax_rate, penalty_multiplier, [current_power]).iloc[0]
+
+    p1, p2, p3 = st.columns(3)
+    p1.metric("최적 계약 전력", f"{best['계약전력(kW)']:,.0f}kW", delta=f"{best['계약전력(kW)'] - current_power:+,.0f}kW", delta_color="off")
+    p2.metric("최적 시 기본요금+부가금", f"{int(best['합계']):,}원")
+    p3.metric("현재 대비 절감", f"{int(current['합계'] - best['합계']):,}원", help=f"{len(monthly_peaks)}개월 합계 기준")
+
+    sweep_chart = alt.Chart(sweep).transform_fold(['기본요금', '초과부가금', '합계'], as_=['항목', '금액']).mark_line().encode(
+        x=alt.X('계약전력(kW):Q'),
+        y=alt.Y('금액:Q'),
+        color=alt.Color('항목:N'),
+        tooltip=[alt.Tooltip('계약전력(kW):Q'), alt.Tooltip('항목:N'), alt.Tooltip('금액:Q', format=',.0f')]
+    ).properties(height=280)
+    st.altair_chart(sweep_chart, use_container_width=True)
+
+@st.fragment
+def what_if_panel(clean_df, loss_rate, fixed_cost, tax_rate, current_price, current_surcharge):
+    # 판매단가 x 손실률 격자 전체를 한 번에 계산 (슬라이더를 움직여도 이 조각만 다시 실행)
+    st.subheader("🧮 판매단가 x 손실률 민감도")
+    w1, w2, w3 = st.columns(3)
+    price_range = w1.slider("판매단가 범위 (원/kWh)", 0.0, 1000.0,
+                            (max(current_price - 150.0, 0.0), current_price + 150.0), 5.0)
+    loss_range = w2.slider("손실률 범위 (%)", 0.0, 30.0, (0.0, 15.0), 0.5)
+    surcharge = w3.number_input("기후+연료비 단가 (원/kWh)", value=float(current_surcharge), step=1.0,
+                                help="연료비조정/기후환경요금 변동을 가정해 볼 때 바꿉니다.")
+    metric = st.radio("표시 항목", ['영업이익', '이익률(%)', 'BEP'], horizontal=True)
+
+    sale_prices = np.arange(price_range[0], price_range[1] + 1e-9, 5.0)
+    loss_rates = np.arange(loss_range[0], loss_range[1] + 1e-9, 0.5)
+    grid = what_if_grid(clean_df, loss_rate, fixed_cost, tax_rate, sale_prices, loss_rates, [surcharge])
+
+    # 이익/이익률은 0(손익분기)을 가운데 색으로, BEP는 낮을수록 초록
+    if metric == 'BEP':
+        color_scale = alt.Scale(scheme='redyellowgreen', reverse=True)
+    else:
+        color_scale = alt.Scale(scheme='redyellowgreen', domainMid=0)
+    heatmap = alt.Chart(grid).mark_rect().encode(
+        x=alt.X('판매단가:O', axis=alt.Axis(labelAngle=0, values=list(sale_prices[::max(len(sale_prices) // 10, 1)]))),
+        y=alt.Y('손실률(%):O', sort='descending'),
+        color=alt.Color(f'{metric}:Q', scale=color_scale),
+        tooltip=[alt.Tooltip('판매단가:Q'), alt.Tooltip('손실률(%):Q'),
+                 alt.Tooltip('영업이익:Q', format=',.0f'), alt.Tooltip('이익률(%):Q', format='.1f'), alt.Tooltip('BEP:Q', format=',.1f')]
+    ).properties(height=320)
+    st.altair_chart(heatmap, use_container_width=True)
+
+    # 손실률별 손익분기 판매단가 (BEP는 판매단가와 무관)
+    bep_by_loss = grid.groupby('손실률(%)')['BEP'].first()
+    st.caption(f"{len(grid):,}개 조합 계산 · 손익분기 판매단가: 손실률 {loss_rates[0]:.1f}% {bep_by_loss.iloc[0]:,.1f}원 ~ "
+               f"{loss_rates[-1]:.1f}% {bep_by_loss.iloc[-1]:,.1f}원")
+
+@st.fragment
+def load_shift_panel(clean_df, band_minutes, demand_profile, rate_tables, holidays, version_dates, tax_rate, contract_power):
+    # 스마트 충전 가정: 세션을 최대 지연 시간 안에서 요금이 가장 싼 시각으로 통째로 옮겨 재계산
+    # 이동 전 구간 분해/수요 곡선은 이미 계산한 것(band_minutes, demand_profile)을 쓰고 이동 후만 새로 계산
+    st.subheader("🔀 부하 이동 시뮬레이션")
+    s1, s2 = st.columns(2)
+    max_delay_hours = s1.slider("최대 지연 (시간)", 0.0, 24.0, 4.0, 0.25,
+                                help="충전 종료가 원래 종료 시각 + 최대 지연 안에 끝나야 합니다 (출차 시각 여유).")
+    step_minutes = s2.selectbox("지연 단위 (분)", [15, 30, 60], index=0)
+
+    starts, ends, buy_kwh = clean_df['분석_시작'], clean_df['분석_종료'], clean_df['매입_전력량']
+    delay, shifted_cost = simulate_load_shift(starts, ends, buy_kwh, rate_tables, int(max_delay_hours * 60), step_minutes,
+                                              holidays, version_dates)
+    before = clean_df['TOU요금_실제'].sum()
+    after = shifted_cost.sum()
+    moved = delay > 0
+
+    h1, h2, h3, h4 = st.columns(4)
+    h1.metric("현재 전력량요금", f"{int(before):,}원")
+    h2.metric("이동 후 전력량요금", f"{int(after):,}원", delta=f"{(after - before) / before * 100:+.1f}%" if before > 0 else None,
+              delta_color="inverse")
+    h3.metric("절감액 (세후)", f"{int((before - after) * (1 + tax_rate)):,}원")
+    h4.metric("이동 세션", f"{moved.mean() * 100:.1f}%", help=f"이동한 세션의 평균 지연 {delay[moved].mean() / 60 if moved.any() else 0:.1f}시간")
+
+    # 요금구간별 충전량 변화
+    shift_delta = pd.to_timedelta(delay, unit='m')
+    band_before = band_kwh_totals(band_minutes, buy_kwh)
+    band_after = band_kwh_totals(decompose_band_minutes(starts + shift_delta, ends + shift_delta, holidays, version_dates), buy_kwh)
+    band_change = pd.DataFrame({
+        '요금구간': LOAD_NAMES * 2,
+        '구분': ['현재'] * len(LOAD_NAMES) + ['이동 후'] * len(LOAD_NAMES),
+        '충전량(kWh)': np.concatenate([
+            band_before.reshape(-1, BANDS_PER_VERSION).sum(axis=0).reshape(-1, len(LOAD_NAMES)).sum(axis=0),
+            band_after.reshape(-1, BANDS_PER_VERSION).sum(axis=0).reshape(-1, len(LOAD_NAMES)).sum(axis=0),
+        ]),
+    })
+    shift_chart = alt.Chart(band_change).mark_bar().encode(
+        x=alt.X('구분:N', sort=['현재', '이동 후'], title=None),
+        y=alt.Y('충전량(kWh):Q', stack='zero'),
+        color=alt.Color('요금구간:N', scale=alt.Scale(domain=list(LOAD_COLORS.keys()), range=list(LOAD_COLORS.values()))),
+        tooltip=['구분', '요금구간', alt.Tooltip('충전량(kWh):Q', format=',.0f')]
+    ).properties(height=260)
+    st.altair_chart(shift_chart, use_container_width=True)
+
+    # 싼 시간대로 몰리면 최대수요가 올라갈 수 있으므로 함께 표시
+    peak_before = demand_profile['수요(kW)'].max()
+    peak_after = build_demand_profile(starts + shift_delta, ends + shift_delta, buy_kwh, holidays=holidays)['수요(kW)'].max()
+    st.caption(f"15분 최대 수요: {peak_before:,.1f}kW → {peak_after:,.1f}kW")
+    if peak_after > contract_power >= peak_before:
+        st.warning(f"이동 후 최대 수요가 계약 전력 {contract_power:,}kW를 넘습니다. 기본요금/초과 부가금을 함께 확인하세요.")
+
+@st.fragment
+def detail_table_panel(clean_df):
+    # 필터/정렬/페이지 이동은 이 조각만 다시 실행. 스타일은 보이는 페이지에만 적용
+    st.subheader("📝 상세 데이터")
+    if clean_df.empty:
+        st.info("필터 조건에 맞는 세션이 없습니다. 사이드바의 데이터 필터를 확인하세요.")
+        return
+    f1, f2, f3, f4 = st.columns([2, 2, 1, 1])
+    first_day, last_day = clean_df['분석_시작'].min().date(), clean_df['분석_시작'].max().date()
+    period = f1.date_input("기간", value=(first_day, last_day), min_value=first_day, max_value=last_day)
+    sort_col = f2.selectbox("정렬", list(DETAIL_COLUMNS.values()), index=0)
+    descending = f3.toggle("내림차순", value=False)
+    page_size = f4.selectbox("페이지당 행", DETAIL_PAGE_SIZES, index=1)
+
+    starts = clean_df['분석_시작']
+    mask = starts.dt.date >= period[0]
+    if len(period) == 2:
+        mask &= starts.dt.date <= period[1]
+    filtered = clean_df[mask]
+    order_col = next(k for k, v in DETAIL_COLUMNS.items() if v == sort_col)
+    order = np.argsort(filtered[order_col].to_numpy(), kind='stable')
+    if descending:
+        order = order[::-1]
+
+    n_pages = max((len(filtered) - 1) // page_size + 1, 1)
+    p1, p2 = st.columns([1, 4])
+    page = p1.number_input("페이지", min_value=1, max_value=n_pages, value=1, step=1)
+    p2.caption(f"{len(filtered):,}건 중 {(page - 1) * page_size + 1:,}–{min(page * page_size, len(filtered)):,} · 총 {n_pages:,}페이지")
+
+    page_df = filtered.iloc[order[(page - 1) * page_size:page * page_size]][list(DETAIL_COLUMNS)].rename(columns=DETAIL_COLUMNS)
+    st.dataframe(
+        page_df.style.format({
+            '판매량(kWh)': '{:.2f}',
+            '한전단가(표준)': '{:.1f}',
+            '매출': '{:,.0f}',
+            '실제원가총액(세금포함)': '{:,.0f}'
+        }).background_gradient(subset=['한전단가(표준)'], cmap='Reds'),
+        use_container_width=True, height=min(600, 38 + 35 * len(page_df)), hide_index=True
+    )
+
+    # 내보내기 파일은 버튼을 누를 때 만든다 (화면을 다시 그릴 때마다 만들지 않음)
+    e1, e2 = st.columns([1, 3])
+    label = e1.radio("내보내기 형식", list(export.EXPORT_FORMATS), horizontal=True)
+    kind = export.EXPORT_FORMATS[label]
+    e2.download_button(
+        f"📥 {label} 다운로드 (현재 필터 {len(filtered):,}건)", data=partial(export.export_file, filtered, kind),
+        file_name=f"분석결과_최종.{kind}", mime=export.EXPORT_MIME[kind], on_click='ignore'
+    )
 
 # ---------------------------------------------------------
 # 3. 메인 화면 UI
@@ -125,6 +272,21 @@ with st.sidebar:
     
     contract_power = st.number_input("계약 전력 (kW)", value=100)
     base_rate_unit = st.number_input("기본요금 단가", value=default_base_cost, disabled=True)
+    use_holidays = st.checkbox("공휴일 경부하 적용", value=True, help="관공서 공휴일(대체·임시공휴일 포함)을 일요일과 같이 경부하로 계산합니다.")
+
+    with st.expander("📅 기간 중 요금 개정"):
+        apply_revision = st.checkbox("요금 개정 반영", value=False)
+        revision_date = st.date_input("개정 적용일", value=date(date.today().year, 1, 1), disabled=not apply_revision)
+        revision_delta = st.number_input("전력량요금 조정 (원/kWh)", value=0.0, step=0.1, disabled=not apply_revision,
+                                         help="개정 적용일부터 모든 시간대 단가에 더합니다 (인하는 음수).")
+
+    holidays = KR_HOLIDAYS if use_holidays else ()
+    if apply_revision:
+        version_dates = (revision_date.isoformat(),)
+        tariff_tables = [current_rates, shift_rate_table(current_rates, revision_delta)]
+    else:
+        version_dates = ()
+        tariff_tables = current_rates
     
     st.divider()
     st.header("2. 변동비/손실 설정")
@@ -145,78 +307,124 @@ with st.sidebar:
     
     base_cost_final = (contract_power * base_rate_unit) * (1 + VAT_RATE + FUND_RATE)
 
-uploaded_file = st.file_uploader("엑셀 데이터 업로드", type=['xlsx', 'xls'])
+    st.divider()
+    st.header("⚖️ 요금제 비교")
+    compare_mode = st.checkbox("요금제 비교 모드", value=False, help="같은 데이터를 여러 요금표로 한 번에 계산합니다.")
+
+    st.divider()
+    st.header("💾 누적 저장소")
+    use_store = st.checkbox("누적 저장소 사용", value=False,
+                            help="업로드한 세션을 저장해 두고, 다음 업로드에서는 처음 보는 세션만 추가합니다. 분석은 저장된 전체 세션 기준입니다.")
+    station = st.text_input("충전소 이름", value=session_store.DEFAULT_STATION, disabled=not use_store,
+                            help="충전소마다 서버의 저장소 폴더 아래에 따로 쌓입니다.")
+    store_dir = None
+    if use_store:
+        stations = session_store.list_stations()
+        if stations:
+            st.caption("기존 충전소: " + ", ".join(stations))
+        try:
+            store_dir = session_store.station_dir(station)
+        except ValueError as e:
+            st.error(str(e))
+
+    st.divider()
+    show_diagnostics = st.checkbox("🩺 진단 정보 표시", value=False,
+                                   help="분석 단계별 소요 시간/처리 행 수/최대 메모리를 표시합니다. "
+                                        "메모리 측정 때문에 분석이 느려지므로 필요할 때만 켜세요.")
+
+uploaded_file = st.file_uploader("충전 데이터 업로드 (엑셀/CSV/Parquet)", type=ingest.SUPPORTED_TYPES)
 
 if uploaded_file is not None:
     try:
-        df = pd.read_excel(uploaded_file)
-        cols = df.columns.tolist()
+        file_bytes = uploaded_file.getvalue()
+        file_hash = file_digest(file_bytes)
+        # 컬럼 선택은 앞부분 미리보기만으로 처리, 전체 읽기는 분석 시작 시점에
+        preview = cached_preview(file_hash, uploaded_file.name, file_bytes)
+        cols = preview.columns.tolist()
+        with st.expander(f"🔎 데이터 미리보기 (앞 {len(preview)}행)", expanded=False):
+            st.dataframe(preview, use_container_width=True)
         
         c1, c2, c3, c4 = st.columns(4)
-        start_col = c1.selectbox("시작 시간", cols, index=cols.index(find_column(cols, ['시작', 'Start'])) if find_column(cols, ['시작', 'Start']) else 0)
-        end_col = c2.selectbox("종료 시간", cols, index=cols.index(find_column(cols, ['종료', 'End'])) if find_column(cols, ['종료', 'End']) else 0)
-        kwh_col = c3.selectbox("충전량", cols, index=cols.index(find_column(cols, ['충전량', 'kWh'])) if find_column(cols, ['충전량', 'kWh']) else 0)
+        start_guess = detect_column(preview, ['시작', 'Start'], 'datetime', pick=0)
+        end_guess = detect_column(preview, ['종료', 'End'], 'datetime', pick=1)
+        kwh_guess = detect_column(preview, ['충전량', 'kWh'], 'number')
+        start_col = c1.selectbox("시작 시간", cols, index=cols.index(start_guess) if start_guess is not None else 0)
+        end_col = c2.selectbox("종료 시간", cols, index=cols.index(end_guess) if end_guess is not None else 0)
+        kwh_col = c3.selectbox("충전량", cols, index=cols.index(kwh_guess) if kwh_guess is not None else 0)
         
-        price_col_guess = find_column(cols, ['단가', 'Price'])
+        price_col_guess = match_column(cols, ['단가', 'Price'])
         use_price_col = c4.checkbox("엑셀 판매단가 사용", value=bool(price_col_guess))
         if use_price_col:
             price_col = c4.selectbox("판매단가 컬럼", cols, index=cols.index(price_col_guess) if price_col_guess else 0)
         else:
             manual_price = c4.number_input("고정 판매단가 (원)", value=300)
 
-        if st.button("🚀 분석 시작"):
-            with st.spinner('요금표 기준 단가 산출 중...'):
-                raw_df = df.copy()
-                
-                # 전처리
-                raw_df['분석_시작'] = pd.to_datetime(raw_df[start_col], errors='coerce')
-                raw_df['분석_종료'] = pd.to_datetime(raw_df[end_col], errors='coerce')
-                raw_df['분석_충전량'] = raw_df[kwh_col].apply(clean_number)
-                raw_df['충전시간(분)'] = (raw_df['분석_종료'] - raw_df['분석_시작']).dt.total_seconds() / 60
-                
-                valid_df = raw_df.dropna(subset=['분석_시작', '분석_종료'])
-                clean_df = valid_df[
-                    (valid_df['충전시간(분)'] >= filter_min_minutes) & 
-                    (valid_df['분석_충전량'] >= filter_min_kwh)
-                ].copy()
-
-                # 손실 반영 (수익 계산용)
-                clean_df['판매_전력량'] = clean_df['분석_충전량']
-                clean_df['매입_전력량'] = clean_df['판매_전력량'] * (1 + loss_rate / 100)
-                
-                # 비용 계산
-                cost_results = clean_df.apply(lambda x: calculate_tou_cost_photo(x['분석_시작'], x['분석_종료'], x['매입_전력량'], current_rates), axis=1, result_type='expand')
-                
-                clean_df['TOU요금_실제'] = cost_results[0]
-                clean_df['요금표단가'] = cost_results[1] # 순수 한전 단가
-                
-                clean_df['기후_연료비'] = clean_df['매입_전력량'] * (climate_rate + fuel_adj_rate)
-                clean_df['변동비_세후_총액'] = (clean_df['TOU요금_실제'] + clean_df['기후_연료비']) * (1 + VAT_RATE + FUND_RATE)
-                
-                if use_price_col:
-                    clean_df['매출액'] = clean_df['판매_전력량'] * clean_df[price_col].apply(clean_number)
-                else:
-                    clean_df['매출액'] = clean_df['판매_전력량'] * manual_price
-
-                # 집계 (돈 계산)
-                total_sales = clean_df['매출액'].sum()
-                total_cost_bill = clean_df['변동비_세후_총액'].sum() + base_cost_final + etc_cost_input
-                operating_profit = total_sales - total_cost_bill
-                total_sold_kwh = clean_df['판매_전력량'].sum()
-                
-                # 집계 (단가 분석 - 요금표 기준)
-                if total_sold_kwh > 0:
-                    # 가중평균 계산을 위한 분자 (순수 요금표 단가 * 판매량의 총합)
-                    sum_weighted_tou = (clean_df['요금표단가'] * clean_df['판매_전력량']).sum()
-                    weighted_avg_rate = sum_weighted_tou / total_sold_kwh
-                    
-                    max_rate = clean_df['요금표단가'].max()
-                    min_rate = clean_df[clean_df['요금표단가'] > 0]['요금표단가'].min()
-                    
-                    # BEP (실제 비용 기준)
-                    bep_cost = total_cost_bill / total_sold_kwh
-                else:
-                    sum_weighted_tou=0; weighted_avg_rate=0; max_rate=0; min_rate=0; bep_cost=0;
+        if compare_mode:
+            st.caption("비교할 요금표를 수정하거나 행을 추가하세요 (예: 내년 한전 발표 단가).")
+            scenario_df = st.data_editor(default_scenarios(), num_rows='dynamic', use_container_width=True, key='scenario_editor')
+
+        # 무거운 단계(읽기/전처리/구간 분해)만 백그라운드 작업으로 돌리고 결과는 공유 보관소(analysis_results)에.
+        # 요금/화면 옵션을 바꾸면 보관된 결과로 요금 계산(행렬 곱)만 다시 한다
+        price_col_used = price_col if use_price_col else None
+        store_used = str(store_dir) if store_dir is not None else None
+        load_key = (file_hash, start_col, end_col, kwh_col, price_col_used, filter_min_minutes, filter_min_kwh,
+                    holidays, version_dates, store_used)
+        if st.button("🚀 분석 시작", disabled=use_store and store_dir is None):
+            previous = st.session_state.get('analysis_job')
+            if previous is not None:
+                previous.cancel()
+            st.session_state['analysis_job'] = AnalysisJob(partial(
+                run_session_load, file_bytes, uploaded_file.name, file_hash, start_col, end_col, kwh_col,
+                price_col_used, filter_min_minutes, filter_min_kwh, holidays, version_dates, store_used, show_diagnostics
+            ), key=load_key).start()
+
+        job = st.session_state.get('analysis_job')
+        if job is not None and not job.done:
+            analysis_progress(job)
+        elif job is not None:
+            del st.session_state['analysis_job']
+            if job.cancelled:
+                st.warning("분석을 취소했습니다.")
+            elif job.error is not None:
+                st.error(f"오류: {job.error}")
+            else:
+                result_key = job.key + (job.result['store_version'],)
+                analysis_results().put(result_key, dict(job.result, elapsed=job.elapsed))
+                st.session_state['analysis_key'] = result_key
+
+        analysis = analysis_results().get(analysis_result_key(load_key, store_used))
+        if analysis is None and st.session_state.get('analysis_key') is not None and (job is None or job.done):
+            st.info("파일/컬럼/필터/공휴일 설정이나 저장소 내용이 바뀌었습니다 (또는 보관된 결과가 만료됨). "
+                    "'🚀 분석 시작'을 다시 눌러주세요.")
+        if analysis is not None:
+            stages = StageLog()
+            with track_peak_memory(show_diagnostics) as mem_stats:
+                sessions, band_minutes = analysis['sessions'], analysis['band_minutes']
+                if analysis['store_rows'] is not None:
+                    n_file_rows, n_new_rows = analysis['store_rows']
+                    st.caption(f"💾 저장소: 파일 {n_file_rows:,}건 중 신규 {n_new_rows:,}건 추가, 누적 {len(sessions):,}건으로 분석")
+                    with st.expander("저장소 업로드 이력", expanded=False):
+                        st.dataframe(session_store.store_uploads(store_used), use_container_width=True)
+                # 세션별 요금/매출 계산 (price_sessions는 새 DataFrame을 만들므로 보관된 세션은 그대로)
+                with stages.stage('요금 계산', rows=len(sessions)):
+                    clean_df = price_sessions(
+                        sessions, band_minutes, tariff_tables, loss_rate, climate_rate + fuel_adj_rate,
+                        VAT_RATE + FUND_RATE, None if use_price_col else manual_price
+                    )
+
+                # 집계 (기본요금은 데이터가 걸친 청구월 수만큼)
+                with stages.stage('요약 집계', rows=len(clean_df)):
+                    n_months = max(len(billing_months(clean_df['분석_시작'])), 1)
+                    summary = summarize_sessions(clean_df, base_cost_final * n_months + etc_cost_input)
+                total_sales = summary['total_sales']
+                total_cost_bill = summary['total_cost_bill']
+                operating_profit = summary['operating_profit']
+                total_sold_kwh = summary['total_sold_kwh']
+                sum_weighted_tou = summary['sum_weighted_tou']
+                weighted_avg_rate = summary['weighted_avg_rate']
+                max_rate = summary['max_rate']
+                min_rate = summary['min_rate']
+                bep_cost = summary['bep_cost']
 
                 # ------------------------------------
                 # 결과 리포트
@@ -225,7 +433,7 @@ if uploaded_file is not None:
                 st.subheader("📊 경영 성과 (전력기금 2.7% 적용됨)")
                 m1, m2, m3 = st.columns(3)
                 m1.metric("총 매출", f"{int(total_sales):,}원")
-                m2.metric("총 비용", f"{int(total_cost_bill):,}원")
+                m2.metric("총 비용", f"{int(total_cost_bill):,}원", help=f"기본요금 {n_months}개월분 포함")
                 m3.metric("영업이익", f"{int(operating_profit):,}원", 
                           delta=f"{(operating_profit/total_sales*100):.1f}%" if total_sales > 0 else "0%")
                 
@@ -246,47 +454,148 @@ if uploaded_file is not None:
                 k3.metric("최고 싼 시간", f"{min_rate:.1f}원/kWh", help="요금표상 가장 싼 구간")
                 k4.metric("BEP (목표단가)", f"{int(bep_cost)}원/kWh", delta="실비용 기준", delta_color="off", help="BEP는 실제 나가는 돈(세금포함) 기준이어야 하므로 높게 나옵니다.")
 
+                if not clean_df.empty and total_sold_kwh > 0:
+                    st.divider()
+                    what_if_panel(clean_df, loss_rate, base_cost_final * n_months + etc_cost_input, VAT_RATE + FUND_RATE,
+                                  float(total_sales / total_sold_kwh), climate_rate + fuel_adj_rate)
+
+                # 월별 청구 내역
+                if not clean_df.empty:
+                    st.divider()
+                    st.subheader(f"🗓️ 월별 청구 내역 ({n_months}개월)")
+                    with stages.stage('월별 청구', rows=len(clean_df)):
+                        bill_table = monthly_billing(clean_df, band_minutes, tariff_tables, base_cost_final,
+                                                     climate_rate + fuel_adj_rate, VAT_RATE + FUND_RATE)
+                    bill_long = bill_table[LOAD_NAMES].reset_index().melt(id_vars='월', var_name='요금구간', value_name='전력량요금')
+                    bill_chart = alt.Chart(bill_long).mark_bar().encode(
+                        x=alt.X('월:O', axis=alt.Axis(labelAngle=0)),
+                        y=alt.Y('전력량요금:Q', stack='zero'),
+                        color=alt.Color('요금구간:N', scale=alt.Scale(domain=list(LOAD_COLORS.keys()), range=list(LOAD_COLORS.values()))),
+                        tooltip=['월', '요금구간', alt.Tooltip('전력량요금:Q', format=',.0f')]
+                    ).properties(height=300)
+                    st.altair_chart(bill_chart, use_container_width=True)
+                    st.dataframe(bill_table.style.format('{:,.0f}'), use_container_width=True)
+
+                # 요금제 비교
+                if compare_mode:
+                    st.divider()
+                    st.subheader("⚖️ 요금제 비교")
+                    with stages.stage('요금제 비교', rows=len(clean_df)):
+                        scenario_result = compare_scenarios(
+                            band_minutes, clean_df['판매_전력량'], clean_df['매입_전력량'], total_sales, scenario_df,
+                            contract_power, climate_rate + fuel_adj_rate, VAT_RATE + FUND_RATE, etc_cost_input, n_months
+                        )
+                    st.dataframe(
+                        scenario_result.style.format({
+                            '총 비용': '{:,.0f}', '영업이익': '{:,.0f}', '이익률(%)': '{:.1f}',
+                            '평균 요금표 단가': '{:.1f}', 'BEP': '{:.0f}'
+                        }),
+                        use_container_width=True, hide_index=True
+                    )
+                    scenario_chart = alt.Chart(scenario_result).mark_bar().encode(
+                        x=alt.X('요금제:N', sort=None, axis=alt.Axis(labelAngle=0)),
+                        y=alt.Y('영업이익:Q'),
+                        color=alt.condition(alt.datum['영업이익'] > 0, alt.value('#2ecc71'), alt.value('#e74c3c')),
+                        tooltip=['요금제', alt.Tooltip('영업이익:Q', format=',.0f'), alt.Tooltip('BEP:Q', format='.0f')]
+                    ).properties(height=300)
+                    st.altair_chart(scenario_chart, use_container_width=True)
+
+                # 부하 곡선 (전체 충전기 합산 15분 수요)
+                if not clean_df.empty:
+                    st.divider()
+                    st.subheader("🔌 부하 곡선 (15분 평균 수요)")
+                    with stages.stage('부하 곡선', rows=len(clean_df)):
+                        demand_profile = build_demand_profile(clean_df['분석_시작'], clean_df['분석_종료'], clean_df['매입_전력량'],
+                                                              holidays=holidays)
+                        peak_table = peak_demand_table(demand_profile)
+                    overall_peak = peak_table['월 최대(kW)'].max()
+
+                    d1, d2 = st.columns(2)
+                    d1.metric("기간 최대 수요", f"{overall_peak:,.1f}kW", help="손실 반영 매입 전력량 기준, 15분 평균")
+                    d2.metric("계약 전력 대비", f"{overall_peak / contract_power * 100:.0f}%" if contract_power > 0 else "-")
+
+                    daily_peak = demand_profile.groupby(demand_profile['시각'].dt.floor('D'))['수요(kW)'].max().reset_index()
+                    daily_peak.columns = ['날짜', '일 최대 수요(kW)']
+                    peak_line = alt.Chart(daily_peak).mark_line().encode(
+                        x=alt.X('날짜:T'),
+                        y=alt.Y('일 최대 수요(kW):Q'),
+                        tooltip=[alt.Tooltip('날짜:T'), alt.Tooltip('일 최대 수요(kW):Q', format=',.1f')]
+                    )
+                    contract_rule = alt.Chart(pd.DataFrame({'계약 전력(kW)': [contract_power]})).mark_rule(
+                        color='#e74c3c', strokeDash=[4, 4]
+                    ).encode(y='계약 전력(kW):Q')
+                    st.altair_chart((peak_line + contract_rule).properties(height=300), use_container_width=True)
+
+                    with st.expander("📋 월별 · 요금구간별 최대 수요", expanded=False):
+                        st.dataframe(
+                            peak_table.style.format({name: '{:,.1f}' for name in LOAD_NAMES + ['월 최대(kW)']}),
+                            use_container_width=True
+                        )
+
+                    contract_power_panel(billed_monthly_peaks(peak_table, clean_df['분석_시작']), base_rate_unit, VAT_RATE + FUND_RATE, contract_power)
+
+                    st.divider()
+                    load_shift_panel(clean_df, band_minutes, demand_profile, tariff_tables, holidays, version_dates,
+                                     VAT_RATE + FUND_RATE, contract_power)
+
                 # 그래프
                 if not clean_df.empty:
                     st.divider()
                     st.subheader("📈 시간대별 사용 패턴")
-                    clean_df['StartHour'] = clean_df['분석_시작'].dt.hour
-                    rep_month = clean_df['분석_시작'].dt.month.iloc[0]
-                    hourly_stats = clean_df.groupby('StartHour')['판매_전력량'].sum().reindex(range(24), fill_value=0).reset_index()
-                    hourly_stats.columns = ['시간(Hour)', '총충전량(kWh)']
-                    hourly_stats['요금구간'] = hourly_stats['시간(Hour)'].apply(lambda h: get_load_type_name(rep_month, h))
+                    # 세션별 kWh를 겹치는 시간마다 나눠 월 x 시 x 요금구간으로 미리 집계 (차트에는 수백 개 점만 전달)
+                    with stages.stage('시간대별 집계', rows=len(clean_df)):
+                        hourly_energy = hourly_energy_table(clean_df['분석_시작'], clean_df['분석_종료'], clean_df['판매_전력량'],
+                                                            holidays=holidays)
+                    hourly_stats = hourly_energy.groupby(['시', '요금구간'], observed=True, as_index=False)['충전량(kWh)'].sum()
+                    hourly_stats.columns = ['시간(Hour)', '요금구간', '총충전량(kWh)']
                     
                     chart = alt.Chart(hourly_stats).mark_bar().encode(
                         x=alt.X('시간(Hour):O', axis=alt.Axis(labelAngle=0)),
-                        y=alt.Y('총충전량(kWh):Q'),
+                        y=alt.Y('총충전량(kWh):Q', stack='zero'),
                         color=alt.Color('요금구간:N', scale=alt.Scale(domain=list(LOAD_COLORS.keys()), range=list(LOAD_COLORS.values()))),
-                        tooltip=['시간(Hour)', '총충전량(kWh)', '요금구간']
+                        tooltip=['시간(Hour)', '요금구간', alt.Tooltip('총충전량(kWh):Q', format=',.1f')]
                     ).properties(height=350)
                     st.altair_chart(chart, use_container_width=True)
 
+                    # 월 x 시간 히트맵 (툴팁에 해당 칸의 요금구간별 충전량)
+                    heat = hourly_energy.pivot_table(index=['월', '시'], columns='요금구간', values='충전량(kWh)',
+                                                     aggfunc='sum', fill_value=0.0, observed=False).reset_index()
+                    heat.columns.name = None
+                    heat['총충전량(kWh)'] = heat[LOAD_NAMES].sum(axis=1)
+                    heatmap = alt.Chart(heat).mark_rect().encode(
+                        x=alt.X('시:O', title='시간(Hour)', axis=alt.Axis(labelAngle=0)),
+                        y=alt.Y('월:O'),
+                        color=alt.Color('총충전량(kWh):Q', scale=alt.Scale(scheme='oranges')),
+                        tooltip=['월', '시', alt.Tooltip('총충전량(kWh):Q', format=',.1f')]
+                            + [alt.Tooltip(f'{name}:Q', format=',.1f') for name in LOAD_NAMES]
+                    ).properties(height=max(120, 24 * heat['월'].nunique()))
+                    st.altair_chart(heatmap, use_container_width=True)
+
                 st.divider()
-                st.subheader("📝 상세 데이터")
-                
-                display_df = clean_df[['분석_시작', '판매_전력량', '요금표단가', '매출액', '변동비_세후_총액']].copy()
-                display_df.columns = ['충전시작', '판매량(kWh)', '한전단가(표준)', '매출', '실제원가총액(세금포함)']
-                
-                try:
+                with stages.stage('상세 표 (스타일 포함)'):
+                    detail_table_panel(clean_df)
+
+            caption = f"불러오기 {analysis['elapsed']:.1f}초"
+            if analysis['peak_mb'] is not None:
+                caption += f" · 최대 메모리 {analysis['peak_mb']:,.1f} MB"
+            if mem_stats['peak_mb'] is not None:
+                caption += f" / 화면 계산 최대 메모리 {mem_stats['peak_mb']:,.1f} MB"
+            st.caption(f"{caption} · 세션 {len(clean_df):,}건")
+
+            # 단계별 계측: 불러오기(백그라운드) + 이번 화면 계산. 로그는 결과가 새로 나왔을 때 한 번만
+            stages = stages.merge(analysis['stages'])
+            if not analysis.get('logged'):
+                stages.log(sessions=len(clean_df), load_seconds=round(analysis['elapsed'], 3))
+                analysis['logged'] = True
+            if show_diagnostics:
+                with st.expander("🩺 진단: 단계별 시간 / 행 수 / 메모리", expanded=True):
+                    diagnostics = stages.table()
                     st.dataframe(
-                        display_df.style.format({
-                            '판매량(kWh)': '{:.2f}', 
-                            '한전단가(표준)': '{:.1f}',
-                            '매출': '{:,.0f}', 
-                            '실제원가총액(세금포함)': '{:,.0f}'
-                        }).background_gradient(subset=['한전단가(표준)'], cmap='Reds'),
-                        use_container_width=True, height=600
+                        diagnostics.style.format({'시간(초)': '{:.3f}', '행 수': '{:,.0f}', '최대 메모리(MB)': '{:,.1f}'}, na_rep='-'),
+                        use_container_width=True, hide_index=True
                     )
-                except:
-                    st.dataframe(display_df, use_container_width=True, height=600)
-                
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    clean_df.to_excel(writer, index=False)
-                st.download_button("📥 엑셀 다운로드", data=output.getvalue(), file_name="분석결과_최종.xlsx")
+                    st.caption("메모리는 tracemalloc 기준 (단계 실행 중 최대, 진단을 켠 뒤 시작한 분석만). 같은 단계 이름은 청크별 기록을 합산합니다. "
+                               "같은 내용이 로그(cost.stages)에 JSON으로 남습니다.")
 
     except Exception as e:
         st.error(f"오류: {e}")
\ No newline at end of file
@@ -0,0 +1,150 @@
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+
+import ingest
+from cost_core import (
+    RATES_DB, VAT_RATE, KR_HOLIDAYS, guess_column, match_column, load_sessions, price_sessions, summarize_sessions,
+    billing_months,
+)
+
+# ---------------------------------------------------------
+# 여러 충전소 파일을 화면 없이 한 번에 분석하는 배치 실행기
+#   python cost_cli.py 데이터폴더 -o summary.csv --contract 고압 --workers 8
+# ---------------------------------------------------------
+DEFAULT_SALE_PRICE = 300
+
+
+def detect_columns(preview):
+    # 화면의 자동 선택과 같은 규칙. 단, 헤더/샘플 어디에도 맞는 컬럼이 없으면 첫 컬럼으로 대신하지 않고 오류
+    # 판매단가는 헤더에 키워드가 있을 때만 사용
+    cols = {
+        'start_col': guess_column(preview, ['시작', 'Start'], 'datetime', pick=0),
+        'end_col': guess_column(preview, ['종료', 'End'], 'datetime', pick=1),
+        'kwh_col': guess_column(preview, ['충전량', 'kWh'], 'number'),
+    }
+    missing = [label for key, label in [('start_col', '충전 시작'), ('end_col', '충전 종료'), ('kwh_col', '충전량')]
+               if cols[key] is None]
+    if missing:
+        raise ValueError(f"{', '.join(missing)} 컬럼을 찾지 못했습니다 (헤더: {preview.columns.tolist()})")
+    cols['price_col'] = match_column(preview.columns.tolist(), ['단가', 'Price'])
+    return cols
+
+
+def analyze_file(path, settings):
+    path = Path(path)
+    data = path.read_bytes()
+    cols = detect_columns(ingest.read_preview(data, path.name))
+    if settings['price'] is not None:
+        price_col, sale_price = None, settings['price']
+    elif cols['price_col'] is not None:
+        price_col, sale_price = cols['price_col'], None
+    else:
+        price_col, sale_price = None, DEFAULT_SALE_PRICE
+
+    sessions, band_minutes = load_sessions(
+        data, path.name, cols['start_col'], cols['end_col'], cols['kwh_col'], price_col,
+        settings['min_minutes'], settings['min_kwh'], KR_HOLIDAYS if settings['holidays'] else ()
+    )
+    if sessions.empty:
+        raise ValueError('최소 충전 시간/충전량 조건을 만족하는 세션이 없습니다')
+    tax_rate = VAT_RATE + settings['fund_rate'] / 100
+    priced = price_sessions(
+        sessions, band_minutes, RATES_DB[settings['contract']]['tou'], settings['loss_rate'],
+        settings['climate_rate'] + settings['fuel_adj_rate'], tax_rate, sale_price
+    )
+    base_cost = settings['contract_power'] * RATES_DB[settings['contract']]['base_cost'] * (1 + tax_rate)
+    n_months = max(len(billing_months(priced['분석_시작'])), 1)
+    summary = summarize_sessions(priced, base_cost * n_months + settings['etc_cost'])
+
+    return {
+        '파일': path.name,
+        '세션수': len(priced),
+        '청구월수': n_months,
+        '판매량(kWh)': summary['total_sold_kwh'],
+        '총 매출': summary['total_sales'],
+        '총 비용': summary['total_cost_bill'],
+        '영업이익': summary['operating_profit'],
+        '평균 요금표 단가': summary['weighted_avg_rate'],
+        'BEP': summary['bep_cost'],
+        '판매단가': price_col if price_col is not None else sale_price,
+    }
+
+
+def safe_analyze(path, settings):
+    # 한 파일의 실패가 전체 배치를 멈추지 않도록 오류는 결과 행에 기록
+    try:
+        return analyze_file(path, settings)
+    except Exception as e:
+        return {'파일': Path(path).name, '오류': f'{type(e).__name__}: {e}'}
+
+
+def find_station_files(directory, recursive=False):
+    pattern = '**/*' if recursive else '*'
+    return sorted(
+        p for p in Path(directory).glob(pattern)
+        if p.is_file() and ingest.file_kind(p.name) in ingest.SUPPORTED_TYPES and not p.name.startswith('~$')
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='충전소별 충전 이력 파일을 일괄 분석해 요약표를 만듭니다.')
+    parser.add_argument('directory', help='충전 이력 파일(xlsx/xls/csv/parquet)이 있는 폴더')
+    parser.add_argument('-o', '--output', default='summary.csv', help='요약 파일 (.csv 또는 .xlsx)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='하위 폴더까지 검색')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='동시 처리 프로세스 수 (기본: CPU 수)')
+    parser.add_argument('--contract', choices=list(RATES_DB), default='저압', help='계약 종별')
+    parser.add_argument('--contract-power', type=float, default=100, help='계약 전력 (kW)')
+    parser.add_argument('--fuel-adj-rate', type=float, default=5.0, help='연료비조정단가 (원)')
+    parser.add_argument('--climate-rate', type=float, default=9.0, help='기후환경요금 (원)')
+    parser.add_argument('--fund-rate', type=float, default=2.7, help='전력기금 (%%)')
+    parser.add_argument('--loss-rate', type=float, default=5.0, help='충전 손실률 (%%)')
+    parser.add_argument('--etc-cost', type=float, default=0, help='원단위 절사/보정 (원)')
+    parser.add_argument('--price', type=float, default=None,
+                        help=f'고정 판매단가 (원). 생략하면 판매단가 컬럼, 없으면 {DEFAULT_SALE_PRICE}원')
+    parser.add_argument('--min-minutes', type=float, default=3, help='최소 충전 시간 (분)')
+    parser.add_argument('--min-kwh', type=float, default=0.5, help='최소 충전량 (kWh)')
+    parser.add_argument('--no-holidays', action='store_true', help='공휴일을 평일과 같이 계산 (기본: 공휴일 경부하)')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    files = find_station_files(args.directory, args.recursive)
+    if not files:
+        print(f'분석할 파일이 없습니다: {args.directory}', file=sys.stderr)
+        return 1
+
+    settings = {
+        'contract': args.contract, 'contract_power': args.contract_power,
+        'fuel_adj_rate': args.fuel_adj_rate, 'climate_rate': args.climate_rate,
+        'fund_rate': args.fund_rate, 'loss_rate': args.loss_rate, 'etc_cost': args.etc_cost,
+        'price': args.price, 'min_minutes': args.min_minutes, 'min_kwh': args.min_kwh,
+        'holidays': not args.no_holidays,
+    }
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(safe_analyze, path, settings): path for path in files}
+        for i, future in enumerate(as_completed(futures), start=1):
+            row = future.result()
+            status = row.get('오류', f"영업이익 {row.get('영업이익', 0):,.0f}원")
+            print(f'[{i}/{len(files)}] {row["파일"]}: {status}', file=sys.stderr)
+            rows.append(row)
+
+    summary = pd.DataFrame(rows).sort_values('파일', ignore_index=True)
+    if args.output.lower().endswith('.xlsx'):
+        summary.to_excel(args.output, index=False)
+    else:
+        summary.to_csv(args.output, index=False, encoding='utf-8-sig')
+
+    failed = summary['오류'].notna().sum() if '오류' in summary else 0
+    print(f'{len(files) - failed}/{len(files)}개 파일 분석 완료 -> {args.output}', file=sys.stderr)
+    return 0 if failed == 0 else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
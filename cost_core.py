@@ -0,0 +1,834 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import ingest
+import preprocess
+
+# 요금 계산/집계 코어. streamlit·altair 없이 import 가능해야 함 (cost18.py 화면, cost_cli.py 배치 공용)
+
+STAGE_LOGGER = logging.getLogger('cost.stages') # 단계별 계측 결과 (JSON 한 줄씩)
+
+# ---------------------------------------------------------
+# 1. 데이터베이스: [선택 II] 요금제 확정
+# ---------------------------------------------------------
+RATES_DB = {
+    '고압': {
+        'base_cost': 2580,
+        'tou': {
+            '봄가을': {'경부하': 80.2, '중간부하': 91.0,  '최대부하': 94.9},
+            '여름':   {'경부하': 78.2, '중간부하': 113.0, '최대부하': 198.6},
+            '겨울':   {'경부하': 95.2, '중간부하': 105.5, '최대부하': 172.4}
+        }
+    },
+    '저압': {
+        'base_cost': 2390,
+        'tou': {
+            '봄가을': {'경부하': 85.4, '중간부하': 97.2,  '최대부하': 102.1},
+            '여름':   {'경부하': 83.1, '중간부하': 140.0, '최대부하': 270.8},
+            '겨울':   {'경부하': 105.8, '중간부하': 126.7, '최대부하': 227.0}
+        }
+    }
+}
+
+SEASONS = {
+    3:'봄가을', 4:'봄가을', 5:'봄가을',
+    6:'여름', 7:'여름', 8:'여름',
+    9:'봄가을', 10:'봄가을',
+    11:'겨울', 12:'겨울', 1:'겨울', 2:'겨울'
+}
+
+# 시간대 정의
+TABLE_SPRING_SUMMER = ([0]*8 + [1]*3 + [2]*1 + [1]*1 + [2]*5 + [1]*4 + [0]*2)
+TABLE_WINTER = ([0]*8 + [1]*1 + [2]*3 + [1]*4 + [2]*3 + [1]*3 + [0]*2)
+
+TIME_TABLE_MAP = {
+    '봄가을': TABLE_SPRING_SUMMER,
+    '여름':   TABLE_SPRING_SUMMER,
+    '겨울':   TABLE_WINTER
+}
+
+LOAD_NAMES = ['경부하', '중간부하', '최대부하']
+SEASON_NAMES = ['봄가을', '여름', '겨울']
+LOAD_COLORS = {'경부하': '#2ecc71', '중간부하': '#f1c40f', '최대부하': '#e74c3c'} 
+VAT_RATE = 0.10
+BANDS_PER_VERSION = len(SEASON_NAMES) * len(LOAD_NAMES) # 요금표 한 벌의 (계절 x 부하) 구간 수
+MAX_CALENDAR_YEARS = 10 # 날짜가 잘못 읽혀 기간이 비정상적으로 길어지는 경우 차단
+
+# 경부하 적용 공휴일 (관공서 공휴일 + 대체/임시공휴일). 새 해 공휴일은 발표되면 추가
+KR_HOLIDAYS = (
+    '2023-01-01', '2023-01-21', '2023-01-22', '2023-01-23', '2023-01-24', '2023-03-01', '2023-05-05',
+    '2023-05-27', '2023-05-29', '2023-06-06', '2023-08-15', '2023-09-28', '2023-09-29', '2023-09-30',
+    '2023-10-02', '2023-10-03', '2023-10-09', '2023-12-25',
+    '2024-01-01', '2024-02-09', '2024-02-10', '2024-02-11', '2024-02-12', '2024-03-01', '2024-04-10',
+    '2024-05-05', '2024-05-06', '2024-05-15', '2024-06-06', '2024-08-15', '2024-09-16', '2024-09-17',
+    '2024-09-18', '2024-10-01', '2024-10-03', '2024-10-09', '2024-12-25',
+    '2025-01-01', '2025-01-27', '2025-01-28', '2025-01-29', '2025-01-30', '2025-03-01', '2025-03-03',
+    '2025-05-05', '2025-05-06', '2025-06-03', '2025-06-06', '2025-08-15', '2025-10-03', '2025-10-05',
+    '2025-10-06', '2025-10-07', '2025-10-08', '2025-10-09', '2025-12-25',
+    '2026-01-01', '2026-02-16', '2026-02-17', '2026-02-18', '2026-03-01', '2026-03-02', '2026-05-05',
+    '2026-05-24', '2026-05-25', '2026-06-03', '2026-06-06', '2026-08-15', '2026-08-17', '2026-09-24',
+    '2026-09-25', '2026-09-26', '2026-10-03', '2026-10-05', '2026-10-09', '2026-12-25',
+)
+DEMAND_INTERVAL_MINUTES = 15 # 최대수요전력 측정 단위
+SHIFT_CHUNK_SESSIONS = 50_000 # 부하 이동 시뮬레이션에서 (세션 x 후보 지연) 행렬을 나눠 계산하는 단위
+# ---------------------------------------------------------
+# 2. 요금 계산 / 집계 함수
+# ---------------------------------------------------------
+def match_column(columns, keywords):
+    # 헤더에 키워드가 들어간 첫 컬럼, 없으면 None
+    for col in columns:
+        for key in keywords:
+            if key in str(col).replace(" ", ""): return col
+    return None
+
+def find_column(columns, keywords):
+    col = match_column(columns, keywords)
+    if col is not None: return col
+    return columns[0] if len(columns) > 0 else None
+
+def sample_kind(values):
+    # 미리보기 샘플 값으로 컬럼 성격 추정: 'number' / 'datetime' / None
+    values = values.dropna()
+    if values.empty: return None
+    if pd.api.types.is_datetime64_any_dtype(values): return 'datetime'
+    if pd.to_numeric(values, errors='coerce').notna().mean() >= 0.8: return 'number'
+    text = values.astype(str)
+    if pd.to_datetime(text, errors='coerce', format='mixed').notna().mean() >= 0.8: return 'datetime'
+    # '12.5 kWh', '1,200원' 같은 단위/구분기호 포함 숫자
+    if pd.to_numeric(text.str.replace(r'[^\d.]', '', regex=True), errors='coerce').notna().mean() >= 0.8: return 'number'
+    return None
+
+def guess_column(preview, keywords, kind, pick=0):
+    # 헤더 키워드가 우선, 없으면 샘플 값이 kind인 컬럼 중 pick번째. 둘 다 없으면 None
+    cols = preview.columns.tolist()
+    col = match_column(cols, keywords)
+    if col is not None: return col
+    candidates = [col for col in cols if sample_kind(preview[col]) == kind]
+    if candidates: return candidates[min(pick, len(candidates) - 1)]
+    return None
+
+def detect_column(preview, keywords, kind, pick=0):
+    col = guess_column(preview, keywords, kind, pick)
+    if col is not None: return col
+    cols = preview.columns.tolist()
+    return cols[0] if len(cols) > 0 else None
+
+def get_load_type_idx(month, hour, weekday):
+    season = SEASONS[month]
+    base_idx = TIME_TABLE_MAP[season][hour]
+    if weekday == 6: return 0 # 일요일
+    if weekday == 5 and base_idx == 2: return 1 # 토요일
+    return base_idx
+
+def get_load_type_name(month, hour, weekday=0):
+    idx = get_load_type_idx(month, hour, weekday)
+    return LOAD_NAMES[idx]
+
+def calculate_tou_cost_photo(start, end, kwh, rate_table):
+    if pd.isnull(start) or pd.isnull(end): return 0, 0
+    diff = end - start
+    total_minutes = int(diff.total_seconds() / 60)
+    if total_minutes <= 0: return 0, 0
+    
+    kwh_per_min = kwh / total_minutes
+    cost = 0
+    
+    # 순수 요금표 단가 계산용
+    tou_rate_accum = 0 
+    
+    curr = start
+    for _ in range(total_minutes):
+        month = curr.month
+        hour = curr.hour
+        weekday = curr.weekday()
+        
+        idx = get_load_type_idx(month, hour, weekday)
+        load_type = LOAD_NAMES[idx]
+        season = SEASONS[month]
+        
+        price = rate_table[season][load_type]
+        
+        cost += price * kwh_per_min
+        tou_rate_accum += price # 단가 누적
+        curr += timedelta(minutes=1)
+        
+    # 평균 적용 단가 (순수 요금표 기준)
+    avg_tou_rate = tou_rate_accum / total_minutes
+    
+    return cost, avg_tou_rate
+
+@lru_cache(maxsize=None)
+def get_day_band_runs(month, weekday):
+    # 하루 24시간의 부하 구분과, 같은 부하가 끝나는 시각(시)을 함께 계산
+    idxs = [get_load_type_idx(month, h, weekday) for h in range(24)]
+    run_end = [24] * 24
+    for h in range(22, -1, -1):
+        run_end[h] = run_end[h + 1] if idxs[h] == idxs[h + 1] else h + 1
+    return tuple(idxs), tuple(run_end)
+
+@lru_cache(maxsize=8)
+def holiday_dates(holidays):
+    return frozenset(pd.to_datetime(list(holidays)).date)
+
+def calculate_tou_cost_segment(start, end, kwh, rate_table, holidays=KR_HOLIDAYS):
+    # calculate_tou_cost_photo와 같은 결과를, 1분 단위가 아니라
+    # 요금구간/날짜(=월) 경계마다 한 번씩만 계산. holidays에 든 날은 일요일과 같이 처리
+    if pd.isnull(start) or pd.isnull(end): return 0, 0
+    diff = end - start
+    total_minutes = int(diff.total_seconds() / 60)
+    if total_minutes <= 0: return 0, 0
+
+    kwh_per_min = kwh / total_minutes
+    one_min = timedelta(minutes=1)
+
+    holiday_set = holiday_dates(tuple(holidays))
+
+    tou_rate_accum = 0
+    done = 0
+    curr = start
+    while done < total_minutes:
+        weekday = 6 if curr.date() in holiday_set else curr.weekday()
+        idxs, run_end = get_day_band_runs(curr.month, weekday)
+        day_start = curr.replace(hour=0, minute=0, second=0, microsecond=0)
+        boundary = day_start + timedelta(hours=run_end[curr.hour])
+
+        # 경계 이전에 시작하는 분(minute)까지가 같은 요금 구간
+        seg_end = min(total_minutes, -((start - boundary) // one_min))
+        price = rate_table[SEASONS[curr.month]][LOAD_NAMES[idxs[curr.hour]]]
+        tou_rate_accum += price * (seg_end - done)
+
+        done = seg_end
+        curr = start + done * one_min
+
+    cost = tou_rate_accum * kwh_per_min
+    avg_tou_rate = tou_rate_accum / total_minutes
+
+    return cost, avg_tou_rate
+
+# (월, 요일, 시) -> 부하 idx 조회표. 규칙은 get_load_type_idx 그대로 사용
+LOAD_IDX_LUT = np.array([
+    [[get_load_type_idx(m, h, w) if m else 0 for h in range(24)] for w in range(7)]
+    for m in range(13)
+], dtype=np.uint8)
+SEASON_IDX_LUT = np.array([SEASON_NAMES.index(SEASONS[m]) if m else 0 for m in range(13)], dtype=np.uint8)
+
+def rate_vector(rate_table):
+    # 요금표 -> (계절*3 + 부하) 순서의 단가 벡터
+    return np.array([rate_table[s][l] for s in SEASON_NAMES for l in LOAD_NAMES], dtype=float)
+
+def shift_rate_table(rate_table, delta):
+    # 모든 구간 단가를 delta원씩 조정한 요금표 (전력량요금 일괄 인상/인하)
+    return {season: {load: price + delta for load, price in loads.items()} for season, loads in rate_table.items()}
+
+def tariff_price_vector(rate_tables, n_codes):
+    # 요금표 하나(dict)면 모든 개정 버전에 같은 단가, 리스트면 개정 버전 순서대로 -> (n_codes,)
+    n_versions = n_codes // BANDS_PER_VERSION
+    if isinstance(rate_tables, dict):
+        rate_tables = [rate_tables] * n_versions
+    if len(rate_tables) != n_versions:
+        raise ValueError(f"요금표 {len(rate_tables)}개, 개정 버전 {n_versions}개가 맞지 않습니다.")
+    return np.concatenate([rate_vector(t) for t in rate_tables])
+
+class TariffCalendar:
+    # first_year 1/1 ~ last_year 12/31의 요금 달력. 한 번 만들어 모든 일괄 계산 경로가 공유
+    #   hour_load   : (일 x 24시) 부하 idx, 공휴일은 일요일과 같이 경부하
+    #   day_season  : 일별 계절 idx
+    #   day_version : 일별 요금 개정 버전 (0 = 첫 개정일 이전)
+    # 분 단위 코드 = 버전 * 9 + 계절 * 3 + 부하
+    def __init__(self, first_year, last_year, holidays=(), version_dates=()):
+        if len(version_dates) + 1 > 255 // BANDS_PER_VERSION:
+            raise ValueError("요금 개정 버전이 너무 많습니다.")
+        self.day0 = np.datetime64(f'{first_year}-01-01', 'D')
+        days = pd.date_range(self.day0, f'{last_year}-12-31', freq='D')
+        self.n_days = len(days)
+        self.n_versions = len(version_dates) + 1
+        self.n_codes = self.n_versions * BANDS_PER_VERSION
+
+        months = days.month.to_numpy()
+        weekdays = np.where(days.isin(pd.to_datetime(list(holidays))), 6, days.weekday.to_numpy())
+        self.hour_load = LOAD_IDX_LUT[months, weekdays]
+        self.day_season = SEASON_IDX_LUT[months]
+        self.day_version = np.searchsorted(
+            pd.to_datetime(sorted(version_dates)).to_numpy('datetime64[ns]'), days.to_numpy('datetime64[ns]'), side='right'
+        ).astype(np.uint8)
+        self._hour_codes = None
+        self._minute_codes = None
+        self._hour_prefix = None
+
+    def hour_codes(self):
+        # 1시간마다의 코드 (uint8). 요금 구간은 정시에만 바뀐다
+        if self._hour_codes is None:
+            day_base = self.day_version.astype(np.int32) * BANDS_PER_VERSION + self.day_season * len(LOAD_NAMES)
+            self._hour_codes = (day_base[:, None] + self.hour_load).astype(np.uint8).ravel()
+        return self._hour_codes
+
+    def minute_codes(self):
+        # 1분마다의 코드 (uint8)
+        if self._minute_codes is None:
+            self._minute_codes = np.repeat(self.hour_codes(), 60)
+        return self._minute_codes
+
+    def code_hour_prefix(self):
+        # 코드별 누적 분 수를 정시마다 (n_codes x (시간 수 + 1), int32). 분 단위로 두면 60배 커진다
+        # 위치 p(분)까지의 누적 = prefix[:, p // 60] + (p % 60) x (그 시간의 코드인지)
+        if self._hour_prefix is None:
+            codes = self.hour_codes()
+            prefix = np.zeros((self.n_codes, len(codes) + 1), dtype=np.int32)
+            for c in range(self.n_codes):
+                np.cumsum(codes == c, out=prefix[c, 1:])
+            prefix *= 60
+            self._hour_prefix = prefix
+        return self._hour_prefix
+
+@lru_cache(maxsize=2)
+def get_tariff_calendar(first_year, last_year, holidays, version_dates):
+    return TariffCalendar(first_year, last_year, holidays, version_dates)
+
+def calendar_for(day0, n_days, holidays=KR_HOLIDAYS, version_dates=()):
+    # day0부터 n_days일을 덮는 (연 단위) 달력과, 달력 시작 기준 day0의 분 위치
+    first_year = int(str(day0.astype('datetime64[Y]')))
+    last_year = int(str((day0 + np.timedelta64(n_days - 1, 'D')).astype('datetime64[Y]')))
+    if last_year - first_year + 1 > MAX_CALENDAR_YEARS:
+        raise ValueError(f"분석 기간이 {MAX_CALENDAR_YEARS}년을 넘습니다 ({first_year}~{last_year}). 날짜 컬럼을 확인하세요.")
+    calendar = get_tariff_calendar(first_year, last_year, tuple(sorted(holidays)), tuple(sorted(version_dates)))
+    shift = int((day0 - calendar.day0) // np.timedelta64(1, 'D')) * 1440
+    return calendar, shift
+
+def session_minute_spans(starts, ends):
+    # 세션별 (day0 기준 시작 분 위치, 충전 분 수). 시간이 없거나 역전된 세션은 0분
+    # 시간대가 있는 시각은 현지 시각 기준 (to_numpy만 하면 UTC로 바뀌어 요금 구간이 어긋남)
+    s = preprocess.to_local_wall_clock(starts).to_numpy('datetime64[ns]')
+    e = preprocess.to_local_wall_clock(ends).to_numpy('datetime64[ns]')
+    valid = ~(np.isnat(s) | np.isnat(e))
+    if not valid.any():
+        n = len(s)
+        return np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64), None, 0
+
+    day0 = s[valid].min().astype('datetime64[D]')
+    s = np.where(valid, s, day0)
+    e = np.where(valid, e, day0)
+
+    offset = (s.astype('datetime64[m]') - day0) // np.timedelta64(1, 'm')
+    total_minutes = np.maximum((e - s) // np.timedelta64(1, 'm'), 0)
+    n_days = int((offset + total_minutes).max()) // 1440 + 1
+    return offset, total_minutes, day0, n_days
+
+def calculate_tou_cost_batch(starts, ends, kwh, rate_table, holidays=KR_HOLIDAYS, version_dates=()):
+    # calculate_tou_cost_photo의 배열 버전: 분 단위 누적 단가(prefix sum)의 차이로 한 번에 계산
+    # rate_table은 요금표 하나 또는 개정 버전별 요금표 리스트
+    offset, total_minutes, day0, n_days = session_minute_spans(starts, ends)
+    kwh = np.asarray(kwh, dtype=float)
+    if day0 is None:
+        return np.zeros(len(kwh)), np.zeros(len(kwh))
+
+    calendar, shift = calendar_for(day0, n_days, holidays, version_dates)
+    prices = tariff_price_vector(rate_table, calendar.n_codes)[calendar.minute_codes()]
+    prefix = np.concatenate(([0.0], np.cumsum(prices)))
+    tou_rate_accum = prefix[shift + offset + total_minutes] - prefix[shift + offset]
+
+    minutes = np.maximum(total_minutes, 1)
+    cost = np.where(total_minutes > 0, tou_rate_accum * kwh / minutes, 0.0)
+    avg_tou_rate = np.where(total_minutes > 0, tou_rate_accum / minutes, 0.0)
+    return cost, avg_tou_rate
+
+def decompose_band_minutes(starts, ends, holidays=KR_HOLIDAYS, version_dates=()):
+    # 세션별 (개정 버전 x 계절 x 부하) 구간에 머문 분(minute) 수 행렬 (n x 9*버전 수).
+    # 요금표와 무관하므로 업로드당 한 번만 계산하고, 요금은 price_band_minutes로 재계산
+    offset, total_minutes, day0, n_days = session_minute_spans(starts, ends)
+    n_codes = (len(version_dates) + 1) * BANDS_PER_VERSION
+    band_minutes = np.zeros((len(offset), n_codes), dtype=np.int32)
+    if day0 is None:
+        return band_minutes
+
+    calendar, shift = calendar_for(day0, n_days, holidays, version_dates)
+    prefix = calendar.code_hour_prefix()
+    hour_codes = calendar.hour_codes()
+    start_hour, start_rest = np.divmod(shift + offset, 60)
+    end_hour, end_rest = np.divmod(shift + offset + total_minutes, 60)
+    # 달력 끝에서 끝나는 세션은 end_rest가 0이므로 마지막 시간 코드로 대신 조회해도 된다
+    start_code = hour_codes[start_hour]
+    end_code = hour_codes[np.minimum(end_hour, len(hour_codes) - 1)]
+    for c in range(n_codes):
+        band_minutes[:, c] = (prefix[c, end_hour] - prefix[c, start_hour]
+                              + np.where(end_code == c, end_rest, 0) - np.where(start_code == c, start_rest, 0))
+    return band_minutes
+
+def price_band_minutes(band_minutes, kwh, rate_table):
+    # decompose_band_minutes 결과 x 단가 벡터 -> (TOU 요금, 평균 요금표 단가)
+    # rate_table은 요금표 하나 또는 개정 버전별 요금표 리스트
+    total_minutes = band_minutes.sum(axis=1)
+    tou_rate_accum = band_minutes @ tariff_price_vector(rate_table, band_minutes.shape[1])
+    minutes = np.maximum(total_minutes, 1)
+    kwh = np.asarray(kwh, dtype=float)
+    cost = np.where(total_minutes > 0, tou_rate_accum * kwh / minutes, 0.0)
+    avg_tou_rate = np.where(total_minutes > 0, tou_rate_accum / minutes, 0.0)
+    return cost, avg_tou_rate
+
+def band_kwh_totals(band_minutes, kwh):
+    # 세션별 kWh를 구간별 체류 시간 비율로 나눠 합산 -> 구간별 총 kWh (9*버전 수,)
+    total_minutes = band_minutes.sum(axis=1)
+    kwh = np.asarray(kwh, dtype=float)
+    kwh_per_min = np.where(total_minutes > 0, kwh / np.maximum(total_minutes, 1), 0.0)
+    return kwh_per_min @ band_minutes
+
+def default_scenarios():
+    # 요금제 비교용 표: RATES_DB의 계약 종별을 한 행씩
+    rows = []
+    for name, db in RATES_DB.items():
+        row = {'요금제': name, '기본요금': db['base_cost']}
+        for season in SEASON_NAMES:
+            for load in LOAD_NAMES:
+                row[f'{season}_{load}'] = db['tou'][season][load]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def compare_scenarios(band_minutes, sold_kwh, buy_kwh, total_sales, scenarios,
+                      contract_power, surcharge_rate, tax_rate, etc_cost, n_months=1):
+    # 세션 분해 결과는 한 번만 집계하고, 요금제별로는 구간 kWh x 단가 행렬 곱만 수행
+    scenarios = scenarios.dropna(subset=['요금제'])
+    band_cols = [f'{season}_{load}' for season in SEASON_NAMES for load in LOAD_NAMES]
+    rate_matrix = scenarios[band_cols].astype(float).to_numpy()
+
+    # 비교 요금표는 기간 전체에 적용하므로 개정 버전 구분은 합쳐서 사용
+    buy_band_kwh = band_kwh_totals(band_minutes, buy_kwh).reshape(-1, BANDS_PER_VERSION).sum(axis=0)
+    sold_band_kwh = band_kwh_totals(band_minutes, sold_kwh).reshape(-1, BANDS_PER_VERSION).sum(axis=0)
+    total_buy_kwh = float(np.sum(buy_kwh))
+    total_sold_kwh = float(np.sum(sold_kwh))
+
+    tou_cost = rate_matrix @ buy_band_kwh
+    variable_cost = (tou_cost + total_buy_kwh * surcharge_rate) * (1 + tax_rate)
+    base_cost = contract_power * scenarios['기본요금'].astype(float).to_numpy() * (1 + tax_rate) * n_months
+    total_cost = variable_cost + base_cost + etc_cost
+    profit = total_sales - total_cost
+
+    result = pd.DataFrame({
+        '요금제': scenarios['요금제'].to_numpy(),
+        '총 비용': total_cost,
+        '영업이익': profit,
+        '이익률(%)': profit / total_sales * 100 if total_sales > 0 else 0.0,
+        '평균 요금표 단가': rate_matrix @ sold_band_kwh / total_sold_kwh if total_sold_kwh > 0 else 0.0,
+        'BEP': total_cost / total_sold_kwh if total_sold_kwh > 0 else 0.0,
+    })
+    return result
+
+def file_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def prepare_sessions(df, start_col, end_col, kwh_col, price_col, datetime_formats=(None, None), stages=None):
+    # 분석용 숫자/날짜 컬럼만 계산해서 반환 (원본 컬럼은 포함하지 않음)
+    stages = stages if stages is not None else StageLog()
+    prepared = pd.DataFrame(index=df.index)
+    with stages.stage('날짜 파싱', rows=len(df)):
+        prepared['분석_시작'] = preprocess.parse_datetimes(df[start_col], datetime_formats[0])
+        prepared['분석_종료'] = preprocess.parse_datetimes(df[end_col], datetime_formats[1])
+    with stages.stage('숫자 정리', rows=len(df)):
+        prepared['분석_충전량'] = preprocess.clean_numbers(df[kwh_col])
+        if price_col is not None:
+            prepared['분석_판매단가'] = preprocess.clean_numbers(df[price_col])
+    prepared['충전시간(분)'] = ((prepared['분석_종료'] - prepared['분석_시작']).dt.total_seconds() / 60).astype(np.float32)
+    return prepared
+
+def iter_clean_chunks(data, name, start_col, end_col, kwh_col, price_col, min_minutes, min_kwh, progress=None,
+                      stages=None):
+    # 파일을 청크 단위로 읽어 전처리/필터까지 마친 세션 청크를 반환
+    # progress(읽은 행 수)는 청크마다 호출 (취소하려면 예외를 던진다)
+    stages = stages if stages is not None else StageLog()
+    usecols = [start_col, end_col, kwh_col] + ([price_col] if price_col is not None else [])
+    datetime_formats = None
+    rows_read = 0
+    chunks = ingest.iter_session_chunks(data, name, usecols)
+    while True:
+        with stages.stage('파일 읽기') as info:
+            chunk = next(chunks, None)
+            info['rows'] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            break
+        rows_read += len(chunk)
+        if progress is not None:
+            progress(rows_read)
+        if datetime_formats is None:
+            # 날짜 형식은 첫 청크에서 한 번만 추정
+            datetime_formats = (preprocess.sniff_datetime_format(chunk[start_col]),
+                                preprocess.sniff_datetime_format(chunk[end_col]))
+        prepared = prepare_sessions(chunk, start_col, end_col, kwh_col, price_col, datetime_formats, stages)
+        valid = prepared['분석_시작'].notna() & prepared['분석_종료'].notna()
+        yield prepared[valid & (prepared['충전시간(분)'] >= min_minutes) & (prepared['분석_충전량'] >= min_kwh)]
+
+def load_sessions(data, name, start_col, end_col, kwh_col, price_col, min_minutes, min_kwh,
+                  holidays=KR_HOLIDAYS, version_dates=(), progress=None, stages=None):
+    # 전처리/필터/구간 분해까지 마친 세션과 분해 행렬을 반환
+    stages = stages if stages is not None else StageLog()
+    parts, band_parts = [], []
+    for part in iter_clean_chunks(data, name, start_col, end_col, kwh_col, price_col, min_minutes, min_kwh,
+                                  progress, stages):
+        parts.append(part)
+        with stages.stage('구간 분해', rows=len(part)):
+            band_parts.append(decompose_band_minutes(part['분석_시작'], part['분석_종료'], holidays, version_dates))
+
+    if not parts:
+        usecols = [start_col, end_col, kwh_col] + ([price_col] if price_col is not None else [])
+        empty = prepare_sessions(pd.DataFrame(columns=usecols), start_col, end_col, kwh_col, price_col)
+        return empty, decompose_band_minutes(empty['분석_시작'], empty['분석_종료'], holidays, version_dates)
+    return pd.concat(parts, ignore_index=True), np.vstack(band_parts)
+
+# tracemalloc은 프로세스에 하나뿐이라 백그라운드 작업/화면 실행/다른 사용자 세션이 같이 쓴다.
+# 최대값은 측정마다 따로 들고 (_peak_watchers), 누가 reset_peak를 하기 전에 지금까지의 최대값을
+# 진행 중인 모든 측정에 넘겨 준다. 시작/종료는 참조 수로 관리해 마지막 측정이 끝날 때만 stop
+_trace_lock = threading.Lock()
+_peak_watchers = []
+_trace_users = 0
+_trace_owned = False
+
+def _fold_and_reset_peak():
+    # _trace_lock 안에서 호출
+    peak = tracemalloc.get_traced_memory()[1]
+    for watcher in _peak_watchers:
+        watcher['peak'] = max(watcher['peak'], peak)
+    tracemalloc.reset_peak()
+
+@contextmanager
+def _watch_peak():
+    # 블록 실행 중 최대 traced 메모리(바이트)를 watcher['peak']에. tracemalloc이 꺼져 있으면 None
+    with _trace_lock:
+        if not tracemalloc.is_tracing():
+            watcher = None
+        else:
+            _fold_and_reset_peak()
+            watcher = {'peak': 0}
+            _peak_watchers.append(watcher)
+    try:
+        yield watcher
+    finally:
+        if watcher is not None:
+            with _trace_lock:
+                _peak_watchers.remove(watcher)
+                if tracemalloc.is_tracing():
+                    watcher['peak'] = max(watcher['peak'], tracemalloc.get_traced_memory()[1])
+
+@contextmanager
+def track_peak_memory(enabled=True):
+    # 블록 실행 중 최대 메모리 (tracemalloc 기준, numpy/pandas 버퍼 포함). 결과는 stats['peak_mb']
+    # 같은 프로세스에서 동시에 돌고 있는 다른 분석의 할당도 함께 잡힌다
+    # tracemalloc은 할당마다 기록하느라 불러오기가 몇 배 느려지므로 진단할 때만 enabled (아니면 peak_mb는 None)
+    global _trace_users, _trace_owned
+    stats = {'peak_mb': None}
+    if not enabled:
+        yield stats
+        return
+    with _trace_lock:
+        if _trace_users == 0:
+            # 밖에서(예: 벤치마크) 이미 켜 둔 tracemalloc은 끄지 않는다
+            _trace_owned = not tracemalloc.is_tracing()
+            if _trace_owned: tracemalloc.start()
+        _trace_users += 1
+    try:
+        with _watch_peak() as watcher:
+            yield stats
+        stats['peak_mb'] = watcher['peak'] / 1024 ** 2
+    finally:
+        with _trace_lock:
+            _trace_users -= 1
+            if _trace_users == 0 and _trace_owned:
+                tracemalloc.stop()
+
+class StageLog:
+    # 파이프라인 단계별 소요 시간/처리 행 수/최대 메모리 기록
+    # 같은 이름의 단계를 여러 번 열면 (청크마다) 합산. 메모리는 tracemalloc이 켜져 있을 때만 (track_peak_memory 안)
+    # context는 JSON 로그에 함께 남길 값 (파일명, 세션 수 등)
+    def __init__(self, **context):
+        self.context = context
+        self.records = {}
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        # 블록 안에서 info['rows']로 처리 행 수를 나중에 채울 수 있다
+        info = {'rows': rows}
+        watcher = None
+        started = time.perf_counter()
+        try:
+            with _watch_peak() as watcher:
+                yield info
+        finally:
+            record = self.records.setdefault(name, {'stage': name, 'calls': 0, 'seconds': 0.0, 'rows': None, 'peak_mb': None})
+            record['calls'] += 1
+            record['seconds'] += time.perf_counter() - started
+            if info['rows'] is not None:
+                record['rows'] = (record['rows'] or 0) + int(info['rows'])
+            if watcher is not None:
+                record['peak_mb'] = max(record['peak_mb'] or 0.0, watcher['peak'] / 1024 ** 2)
+
+    def merge(self, other):
+        # 다른 StageLog(예: 백그라운드 작업)의 기록을 앞에 붙인 새 StageLog
+        merged = StageLog(**{**other.context, **self.context})
+        merged.records = {**other.records, **self.records}
+        return merged
+
+    def table(self):
+        return pd.DataFrame(list(self.records.values()), columns=['stage', 'calls', 'seconds', 'rows', 'peak_mb']).rename(columns={
+            'stage': '단계', 'calls': '호출', 'seconds': '시간(초)', 'rows': '행 수', 'peak_mb': '최대 메모리(MB)',
+        })
+
+    def log(self, **extra):
+        # 단계마다 JSON 한 줄 (STAGE_LOGGER, INFO)
+        for record in self.records.values():
+            line = {'at': time.strftime('%Y-%m-%dT%H:%M:%S'), **self.context, **extra, **record}
+            STAGE_LOGGER.info(json.dumps(line, ensure_ascii=False, default=str))
+
+def price_sessions(sessions, band_minutes, rate_table, loss_rate, surcharge_rate, tax_rate, sale_price=None):
+    # 세션별 매입량/TOU 요금/변동비/매출 계산. sale_price가 None이면 분석_판매단가 컬럼 사용
+    # loss_rate는 %, surcharge_rate는 기후환경+연료비조정 단가, tax_rate는 부가세+전력기금 비율
+    priced = sessions.rename(columns={'분석_충전량': '판매_전력량'})
+
+    # 손실 반영 (수익 계산용)
+    priced['매입_전력량'] = priced['판매_전력량'] * (1 + loss_rate / 100)
+
+    # 비용 계산
+    tou_cost, tou_rate = price_band_minutes(band_minutes, priced['매입_전력량'], rate_table)
+    priced['TOU요금_실제'] = tou_cost
+    priced['요금표단가'] = tou_rate.astype(np.float32) # 순수 한전 단가
+
+    surcharge = priced['매입_전력량'] * surcharge_rate # 기후/연료비
+    priced['변동비_세후_총액'] = (priced['TOU요금_실제'] + surcharge) * (1 + tax_rate)
+
+    if sale_price is None:
+        priced['매출액'] = priced['판매_전력량'] * priced['분석_판매단가']
+    else:
+        priced['매출액'] = priced['판매_전력량'] * sale_price
+    return priced
+
+def summarize_sessions(priced, fixed_cost):
+    # 수익/BEP/가중평균 단가 집계. fixed_cost는 기본요금(세후) + 보정액
+    total_sales = priced['매출액'].sum()
+    total_cost_bill = priced['변동비_세후_총액'].sum() + fixed_cost
+    total_sold_kwh = priced['판매_전력량'].sum()
+
+    if total_sold_kwh > 0:
+        # 가중평균 계산을 위한 분자 (순수 요금표 단가 * 판매량의 총합)
+        sum_weighted_tou = (priced['요금표단가'] * priced['판매_전력량']).sum()
+        weighted_avg_rate = sum_weighted_tou / total_sold_kwh
+        max_rate = priced['요금표단가'].max()
+        min_rate = priced.loc[priced['요금표단가'] > 0, '요금표단가'].min()
+        # BEP (실제 비용 기준)
+        bep_cost = total_cost_bill / total_sold_kwh
+    else:
+        sum_weighted_tou = 0; weighted_avg_rate = 0; max_rate = 0; min_rate = 0; bep_cost = 0
+
+    return {
+        'total_sales': total_sales,
+        'total_cost_bill': total_cost_bill,
+        'operating_profit': total_sales - total_cost_bill,
+        'total_sold_kwh': total_sold_kwh,
+        'sum_weighted_tou': sum_weighted_tou,
+        'weighted_avg_rate': weighted_avg_rate,
+        'max_rate': max_rate,
+        'min_rate': min_rate,
+        'bep_cost': bep_cost,
+    }
+
+def what_if_grid(priced, loss_rate, fixed_cost, tax_rate, sale_prices, loss_rates, surcharge_rates):
+    # 판매단가 x 손실률 x (기후+연료비) 단가 조합 전체의 손익을 한 번에 계산
+    # 세션별 요금표 단가는 손실률/부가단가와 무관하므로 합계 두 개로 충분:
+    #   판매량 S, 요금표 요금 W = sum(판매량 x 요금표단가)  (priced를 만들 때의 loss_rate로 되돌려 구함)
+    #   비용 = (1 + 손실률) x (W + S x 부가단가) x (1 + 세율) + 고정비,  매출 = 판매단가 x S
+    sold_kwh = priced['판매_전력량'].sum()
+    tou_per_sold = priced['TOU요금_실제'].sum() / (1 + loss_rate / 100)
+    price, loss, surcharge = np.meshgrid(
+        np.asarray(sale_prices, dtype=float), np.asarray(loss_rates, dtype=float),
+        np.asarray(surcharge_rates, dtype=float), indexing='ij'
+    )
+    sales = price * sold_kwh
+    cost = (1 + loss / 100) * (tou_per_sold + sold_kwh * surcharge) * (1 + tax_rate) + fixed_cost
+    profit = sales - cost
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margin = np.where(sales > 0, profit / sales * 100, np.nan)
+        bep = cost / sold_kwh if sold_kwh > 0 else np.zeros_like(cost)
+    return pd.DataFrame({
+        '판매단가': price.ravel(),
+        '손실률(%)': loss.ravel(),
+        '부가단가': surcharge.ravel(),
+        '매출': sales.ravel(),
+        '총 비용': cost.ravel(),
+        '영업이익': profit.ravel(),
+        '이익률(%)': margin.ravel(),
+        'BEP': bep.ravel(),
+    })
+
+def simulate_load_shift(starts, ends, kwh, rate_table, max_delay_minutes, step_minutes=DEMAND_INTERVAL_MINUTES,
+                        holidays=KR_HOLIDAYS, version_dates=()):
+    # 세션마다 시작을 0 ~ max_delay_minutes분 (step_minutes 간격) 늦춰 보고 TOU 요금이 가장 낮은 지연을 선택
+    # 충전 시간/충전량은 그대로 두고 통째로 옮긴다 (종료가 원래 종료 + max_delay 안에 들어오도록)
+    # 후보 지연별 요금은 분 단위 누적 단가(prefix sum)의 차이로 한 번에 계산. 반환: (지연(분), 이동 후 TOU 요금)
+    offset, total_minutes, day0, n_days = session_minute_spans(starts, ends)
+    kwh = np.asarray(kwh, dtype=float)
+    n = len(offset)
+    if day0 is None:
+        return np.zeros(n, dtype=np.int64), np.zeros(n)
+
+    delays = np.arange(0, max_delay_minutes + 1, step_minutes, dtype=np.int64)
+    extra_days = -(-int(delays[-1]) // 1440)
+    calendar, shift = calendar_for(day0, n_days + extra_days, holidays, version_dates)
+    prices = tariff_price_vector(rate_table, calendar.n_codes)[calendar.minute_codes()]
+    prefix = np.concatenate(([0.0], np.cumsum(prices)))
+    kwh_per_min = np.divide(kwh, total_minutes, out=np.zeros(n), where=total_minutes > 0)
+
+    best_delay = np.zeros(n, dtype=np.int64)
+    best_cost = np.zeros(n)
+    for i in range(0, n, SHIFT_CHUNK_SESSIONS):
+        part = slice(i, i + SHIFT_CHUNK_SESSIONS)
+        start_pos = shift + offset[part, None] + delays[None, :] # (세션 x 후보 지연)
+        cost = (prefix[start_pos + total_minutes[part, None]] - prefix[start_pos]) * kwh_per_min[part, None]
+        pick = np.argmin(cost, axis=1) # 요금이 같으면 덜 늦추는 쪽
+        best_delay[part] = delays[pick]
+        best_cost[part] = cost[np.arange(len(pick)), pick]
+    return best_delay, best_cost
+
+def minute_power_profile(starts, ends, kwh):
+    # 전체 세션을 합친 1분 단위 전력(kW) 곡선. 세션마다 시작/끝에 +kW/-kW만 기록한 뒤
+    # 누적합으로 복원하므로 세션 수 + 분 수에 비례하는 시간으로 끝난다
+    offset, total_minutes, day0, n_days = session_minute_spans(starts, ends)
+    if day0 is None:
+        return None, np.zeros(0)
+
+    active = total_minutes > 0
+    power = np.asarray(kwh, dtype=float)[active] * 60 / total_minutes[active]
+    n_min = n_days * 1440
+    diff = np.bincount(offset[active], weights=power, minlength=n_min + 1)
+    diff -= np.bincount(offset[active] + total_minutes[active], weights=power, minlength=n_min + 1)
+    minute_kw = np.maximum(np.cumsum(diff[:n_min]), 0.0) # 부동소수 누적 오차로 생기는 -0.0000 제거
+    return day0, minute_kw
+
+def hourly_energy_table(starts, ends, kwh, holidays=KR_HOLIDAYS):
+    # 세션 kWh를 실제로 겹치는 시간에 분 단위로 나눠 배분한 뒤 월 x 시 x 요금구간으로 집계
+    # (시작 시각 한 칸에 몰아넣지 않으므로 심야까지 이어지는 충전도 제 구간에 들어간다)
+    day0, minute_kw = minute_power_profile(starts, ends, kwh)
+    if day0 is None:
+        return pd.DataFrame({'월': pd.Series(dtype=str), '시': pd.Series(dtype=int),
+                             '요금구간': pd.Categorical([], categories=LOAD_NAMES), '충전량(kWh)': pd.Series(dtype=float)})
+
+    hourly_kwh = minute_kw.reshape(-1, 60).sum(axis=1) / 60
+    calendar, shift = calendar_for(day0, len(hourly_kwh) // 24, holidays)
+    load_idx = calendar.minute_codes()[shift:shift + len(minute_kw):60] % len(LOAD_NAMES)
+    times = pd.date_range(pd.Timestamp(day0), periods=len(hourly_kwh), freq='h')
+    hourly = pd.DataFrame({
+        '월': times.strftime('%Y-%m'),
+        '시': times.hour,
+        '요금구간': pd.Categorical.from_codes(load_idx, categories=LOAD_NAMES),
+        '충전량(kWh)': hourly_kwh,
+    })
+    return hourly.groupby(['월', '시', '요금구간'], observed=True, as_index=False)['충전량(kWh)'].sum()
+
+def build_demand_profile(starts, ends, kwh, interval=DEMAND_INTERVAL_MINUTES, holidays=KR_HOLIDAYS):
+    # interval분 평균 수요(kW) 곡선과 각 구간의 월/요금구간
+    if 60 % interval != 0:
+        raise ValueError(f"수요 측정 간격은 60의 약수여야 합니다: {interval}")
+    day0, minute_kw = minute_power_profile(starts, ends, kwh)
+    if day0 is None:
+        return pd.DataFrame({'시각': pd.Series(dtype='datetime64[ns]'), '수요(kW)': pd.Series(dtype=float),
+                             '월': pd.Series(dtype=str), '요금구간': pd.Categorical([], categories=LOAD_NAMES)})
+
+    demand = minute_kw.reshape(-1, interval).mean(axis=1)
+    times = pd.date_range(pd.Timestamp(day0), periods=len(demand), freq=f'{interval}min')
+    # 요금구간은 정시 단위로 바뀌므로 각 측정 구간의 첫 분 코드로 충분
+    calendar, shift = calendar_for(day0, len(minute_kw) // 1440, holidays)
+    load_idx = calendar.minute_codes()[shift:shift + len(minute_kw):interval] % len(LOAD_NAMES)
+    return pd.DataFrame({
+        '시각': times,
+        '수요(kW)': demand,
+        '월': times.strftime('%Y-%m'),
+        '요금구간': pd.Categorical.from_codes(load_idx, categories=LOAD_NAMES),
+    })
+
+def peak_demand_table(profile):
+    # 월 x 요금구간별 최대 수요(kW)와 월 최대 발생 시각
+    table = profile.pivot_table(index='월', columns='요금구간', values='수요(kW)', aggfunc='max', observed=False)
+    table = table.reindex(columns=LOAD_NAMES).fillna(0.0)
+    peak_idx = profile.groupby('월')['수요(kW)'].idxmax()
+    table['월 최대(kW)'] = profile.loc[peak_idx, '수요(kW)'].to_numpy()
+    table['발생 시각'] = profile.loc[peak_idx, '시각'].to_numpy()
+    return table
+
+def billed_monthly_peaks(peak_table, starts):
+    # 월 최대 수요를 청구월(세션 시작 기준)에 맞춤. 마지막 청구월을 넘겨 이어진 세션의 수요는 마지막 청구월에 포함
+    months = billing_months(starts).strftime('%Y-%m')
+    peaks = peak_table['월 최대(kW)']
+    if len(months) == 0:
+        return np.zeros(0)
+    billed = peaks.reindex(months, fill_value=0.0).to_numpy(float, copy=True)
+    spill = peaks[peaks.index > months[-1]]
+    if len(spill):
+        billed[-1] = max(billed[-1], spill.max())
+    return billed
+
+def optimize_contract_power(monthly_peaks, base_rate, tax_rate, penalty_multiplier, candidates=None):
+    # 후보 계약전력 전체를 한 번에 평가: 월 기본요금 + 월 최대수요 초과분 부가금
+    # 부가금 = 초과 kW x 기본요금 단가 x penalty_multiplier (약관 배수는 화면에서 입력)
+    monthly_peaks = np.asarray(monthly_peaks, dtype=float)
+    if candidates is None:
+        upper = np.ceil(monthly_peaks.max() * 1.5) if len(monthly_peaks) else 0
+        candidates = np.arange(0, upper + 1)
+    candidates = np.asarray(candidates, dtype=float)
+
+    excess = np.maximum(monthly_peaks[None, :] - candidates[:, None], 0.0) # (후보 x 월)
+    base_cost = candidates * base_rate * (1 + tax_rate) * len(monthly_peaks)
+    penalty = excess.sum(axis=1) * base_rate * penalty_multiplier * (1 + tax_rate)
+    return pd.DataFrame({
+        '계약전력(kW)': candidates,
+        '기본요금': base_cost,
+        '초과부가금': penalty,
+        '합계': base_cost + penalty,
+    })
+
+def billing_months(starts):
+    # 데이터가 걸친 청구월 (첫 달 ~ 마지막 달, 세션이 없는 달도 기본요금은 나간다)
+    months = pd.DatetimeIndex(starts).dropna().to_period('M')
+    if len(months) == 0:
+        return pd.PeriodIndex([], freq='M')
+    return pd.period_range(months.min(), months.max(), freq='M')
+
+def monthly_billing(priced, band_minutes, rate_table, base_cost_per_month, surcharge_rate, tax_rate):
+    # 청구월 x 요금구간 요금표. 세션은 충전 시작 시각이 속한 달에 청구
+    # rate_table은 요금표 하나 또는 개정 버전별 요금표 리스트
+    # base_cost_per_month는 세후 기본요금, surcharge_rate는 기후환경+연료비조정 단가
+    months = billing_months(priced['분석_시작'])
+    n_months = len(months)
+    starts = priced['분석_시작']
+    month_code = (starts.dt.year * 12 + starts.dt.month).to_numpy()
+    if n_months:
+        month_code = month_code - (months[0].year * 12 + months[0].month)
+
+    total_minutes = band_minutes.sum(axis=1)
+    buy_kwh = priced['매입_전력량'].to_numpy(dtype=float)
+    kwh_per_min = np.where(total_minutes > 0, buy_kwh / np.maximum(total_minutes, 1), 0.0)
+    prices = tariff_price_vector(rate_table, band_minutes.shape[1])
+
+    # 세션 단위 (n x 9) 행렬을 만들지 않고, 구간 열마다 월별로 바로 합산
+    load_cost = np.zeros((n_months, len(LOAD_NAMES)))
+    for c in range(band_minutes.shape[1]):
+        load_cost[:, c % len(LOAD_NAMES)] += np.bincount(
+            month_code, weights=band_minutes[:, c] * kwh_per_min * prices[c], minlength=n_months
+        )
+
+    def month_sum(values):
+        return np.bincount(month_code, weights=np.asarray(values, dtype=float), minlength=n_months)
+
+    table = pd.DataFrame(load_cost, columns=LOAD_NAMES, index=months.strftime('%Y-%m'))
+    table.index.name = '월'
+    table['전력량요금'] = load_cost.sum(axis=1)
+    table['기후·연료비'] = month_sum(buy_kwh) * surcharge_rate
+    table['부가세·기금'] = (table['전력량요금'] + table['기후·연료비']) * tax_rate
+    table['기본요금(세후)'] = base_cost_per_month
+    table['청구 합계'] = table['전력량요금'] + table['기후·연료비'] + table['부가세·기금'] + table['기본요금(세후)']
+    table['판매량(kWh)'] = month_sum(priced['판매_전력량'])
+    table['매출'] = month_sum(priced['매출액'])
+    table['영업이익'] = table['매출'] - table['청구 합계']
+    return table
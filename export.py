@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+import numpy as np
+
+from cost_core import StageLog
+
+# ---------------------------------------------------------
+# 분석 결과 내보내기 (CSV / Parquet / xlsx)
+# EXPORT_CHUNK_ROWS 행씩 임시 파일에 바로 써서, 결과 크기만큼의 사본을 메모리에 더 만들지 않는다
+# ---------------------------------------------------------
+EXPORT_FORMATS = {'CSV': 'csv', 'Parquet': 'parquet', 'Excel': 'xlsx'}
+EXPORT_MIME = {
+    'csv': 'text/csv',
+    'parquet': 'application/octet-stream',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+EXPORT_CHUNK_ROWS = 50_000
+XLSX_MAX_ROWS = 1_048_576 - 1 # 헤더 제외
+
+
+def write_csv(df, path):
+    # 엑셀에서 한글이 깨지지 않도록 BOM 포함 UTF-8
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        for i in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+            df.iloc[i:i + EXPORT_CHUNK_ROWS].to_csv(f, index=False, header=(i == 0))
+
+
+def write_parquet(df, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.Schema.from_pandas(df.iloc[:0], preserve_index=False)
+    with pq.ParquetWriter(path, schema) as writer:
+        for i in range(0, len(df), EXPORT_CHUNK_ROWS):
+            writer.write_table(pa.Table.from_pandas(df.iloc[i:i + EXPORT_CHUNK_ROWS], schema=schema, preserve_index=False))
+
+
+def write_xlsx(df, path):
+    # openpyxl write-only 모드: 행을 파일로 흘려 쓰므로 메모리 사용량이 행 수와 무관
+    if len(df) > XLSX_MAX_ROWS:
+        raise ValueError(f"엑셀 최대 행 수({XLSX_MAX_ROWS:,})를 넘습니다 ({len(df):,}행). CSV나 Parquet으로 내보내세요.")
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append([str(c) for c in df.columns])
+    for i in range(0, len(df), EXPORT_CHUNK_ROWS):
+        chunk = df.iloc[i:i + EXPORT_CHUNK_ROWS].astype(object)
+        chunk = chunk.where(chunk.notna(), None) # NaN/NaT는 빈 칸
+        for row in chunk.itertuples(index=False, name=None):
+            ws.append([v.item() if isinstance(v, np.generic) else v for v in row])
+    wb.save(path)
+
+
+_WRITERS = {'csv': write_csv, 'parquet': write_parquet, 'xlsx': write_xlsx}
+
+
+def export_file(df, kind):
+    # 임시 파일에 쓴 뒤 내용만 돌려준다 (메모리에는 완성된 파일 한 벌만 남음)
+    stages = StageLog(export=kind)
+    fd, path = tempfile.mkstemp(suffix=f'.{kind}')
+    os.close(fd)
+    try:
+        with stages.stage('내보내기', rows=len(df)):
+            _WRITERS[kind](df, path)
+            with open(path, 'rb') as f:
+                data = f.read()
+        stages.log(bytes=len(data))
+        return data
+    finally:
+        os.remove(path)
@@ -0,0 +1,137 @@
+import codecs
+import io
+
+import pandas as pd
+
+# ---------------------------------------------------------
+# 충전 이력 파일 읽기 (xlsx / xls / csv / parquet)
+# 선택한 컬럼만, CHUNK_ROWS 행씩 나눠서 읽어 파일 크기와 무관하게 메모리를 일정하게 유지
+# ---------------------------------------------------------
+SUPPORTED_TYPES = ['xlsx', 'xls', 'csv', 'parquet']
+CHUNK_ROWS = 100_000
+PREVIEW_ROWS = 50
+ENCODING_CHECK_BYTES = 1 << 20 # 인코딩 검사 시 한 번에 디코딩하는 크기 (전체를 문자열로 만들지 않도록)
+
+
+def file_kind(name):
+    return str(name).rsplit('.', 1)[-1].lower()
+
+
+def csv_encoding(data):
+    # 한전/충전기 백엔드 CSV는 UTF-8(BOM 포함) 또는 CP949
+    # 헤더는 영문이고 한글(충전소명 등)은 한참 뒤에 나오는 파일도 있으므로 앞부분이 아니라 전체를 검사
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    view = memoryview(data)
+    try:
+        for i in range(0, len(view), ENCODING_CHECK_BYTES):
+            decoder.decode(view[i:i + ENCODING_CHECK_BYTES], final=False)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'cp949'
+
+
+def header_names(row):
+    # pd.read_excel과 같은 방식으로 빈 헤더는 'Unnamed: i', 중복 헤더는 '이름.1', '이름.2', ...
+    # (이름 있는 컬럼을 먼저 처리하고, 이미 있는 이름과 겹치는 번호는 건너뜀)
+    names = [f'Unnamed: {i}' if v is None else v for i, v in enumerate(row)]
+    unnamed = [i for i, v in enumerate(row) if v is None]
+    order = [i for i in range(len(names)) if row[i] is not None] + unnamed
+    counts = {}
+    for i in order:
+        name = base = names[i]
+        count = counts.get(base, 0)
+        while count > 0:
+            counts[base] = count + 1
+            name = f'{base}.{count}'
+            count = count + 1 if name in names else counts.get(name, 0)
+        names[i] = name
+        counts[name] = count + 1
+    return names
+
+
+def read_preview(data, name, nrows=PREVIEW_ROWS):
+    # 컬럼 선택용: 헤더와 앞쪽 nrows 행만 읽는다
+    kind = file_kind(name)
+    if kind == 'csv':
+        return pd.read_csv(io.BytesIO(data), nrows=nrows, encoding=csv_encoding(data))
+    if kind == 'parquet':
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(io.BytesIO(data))
+        batch = next(pf.iter_batches(batch_size=nrows), None)
+        if batch is None:
+            return pf.schema_arrow.empty_table().to_pandas()
+        return batch.to_pandas()
+    if kind == 'xlsx':
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            # pd.read_excel과 같이 첫 번째 시트 (저장할 때 선택돼 있던 시트가 아니라)
+            rows = wb.worksheets[0].iter_rows(max_row=nrows + 1, values_only=True)
+            header = header_names(next(rows, ()))
+            body = [list(row[:len(header)]) + [None] * (len(header) - len(row)) for row in rows]
+            return pd.DataFrame(body, columns=header)
+        finally:
+            wb.close()
+    return pd.read_excel(io.BytesIO(data), nrows=nrows)
+
+
+def estimate_rows(data, name):
+    # 진행률 표시용 대략적인 데이터 행 수 (알 수 없으면 None)
+    kind = file_kind(name)
+    if kind == 'csv':
+        return max(data.count(b'\n') - 1, 1)
+    if kind == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(io.BytesIO(data)).metadata.num_rows
+    if kind == 'xlsx':
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(data), read_only=True)
+        try:
+            max_row = wb.worksheets[0].max_row
+        finally:
+            wb.close()
+        return max_row - 1 if max_row else None
+    return None
+
+
+def iter_xlsx_chunks(data, usecols, chunksize):
+    # openpyxl read-only 모드: 행을 하나씩 흘려 읽고, 필요한 컬럼만 남긴다
+    from openpyxl import load_workbook
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = header_names(next(rows, ()))
+        positions = [header.index(c) for c in usecols]
+        buf = []
+        for row in rows:
+            buf.append([row[p] if p < len(row) else None for p in positions])
+            if len(buf) >= chunksize:
+                yield pd.DataFrame(buf, columns=usecols)
+                buf = []
+        if buf:
+            yield pd.DataFrame(buf, columns=usecols)
+    finally:
+        wb.close()
+
+
+def iter_session_chunks(data, name, usecols, chunksize=CHUNK_ROWS):
+    # usecols 컬럼만 담은 DataFrame을 chunksize 행씩 반환
+    kind = file_kind(name)
+    usecols = list(dict.fromkeys(usecols))
+    if kind == 'csv':
+        reader = pd.read_csv(io.BytesIO(data), usecols=usecols, chunksize=chunksize,
+                             encoding=csv_encoding(data))
+        for chunk in reader:
+            yield chunk[usecols]
+    elif kind == 'parquet':
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(io.BytesIO(data))
+        for batch in pf.iter_batches(batch_size=chunksize, columns=usecols):
+            yield batch.to_pandas()[usecols]
+    elif kind == 'xlsx':
+        yield from iter_xlsx_chunks(data, usecols, chunksize)
+    else:
+        # xls는 스트리밍 읽기를 지원하지 않으므로 필요한 컬럼만 한 번에 읽는다
+        df = pd.read_excel(io.BytesIO(data), usecols=usecols)[usecols]
+        for i in range(0, len(df), chunksize):
+            yield df.iloc[i:i + chunksize]
@@ -0,0 +1,131 @@
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# ---------------------------------------------------------
+# 충전량/단가 숫자 정리와 날짜 파싱 (행 단위 apply 없이 컬럼 전체를 한 번에 처리)
+# ---------------------------------------------------------
+EXCEL_EPOCH = pd.Timestamp('1899-12-30')
+SNIFF_SAMPLE_ROWS = 200
+LOCAL_TZ = 'Asia/Seoul' # 요금 구간은 한국 현지 시각 기준
+
+_DATE_PARTS = ['%Y-%m-%d', '%Y/%m/%d', '%Y.%m.%d', '%Y. %m. %d.', '%Y년 %m월 %d일', '%Y%m%d']
+_TIME_PARTS = ['%H:%M:%S', '%H:%M', '%p %I:%M:%S', '%p %I:%M', '%H%M%S']
+DATETIME_FORMATS = (
+    [f'{d} {t}' for d in _DATE_PARTS for t in _TIME_PARTS]
+    + ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M'] + _DATE_PARTS
+)
+
+
+def clean_numbers(values):
+    # clean_number의 컬럼 버전: 숫자 컬럼은 그대로, 문자열은 숫자/소수점 외 문자를 지운 뒤 변환
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.astype(float).fillna(0.0)
+    numbers = pd.to_numeric(values, errors='coerce')
+    rest = numbers.isna() & values.notna()
+    if rest.any():
+        text = values[rest].astype(str).str.replace(r'[^\d.]', '', regex=True)
+        numbers[rest] = pd.to_numeric(text, errors='coerce')
+    return numbers.astype(float).fillna(0.0)
+
+
+def excel_serial_to_datetime(values):
+    # 엑셀 일련번호(1900 날짜 체계). 너무 큰 값은 유닉스 초(ms)로 본다
+    numbers = pd.to_numeric(values, errors='coerce').astype(float)
+    median = numbers.median()
+    if pd.notna(median) and median > 1e11:
+        return pd.to_datetime(numbers, unit='ms', errors='coerce')
+    if pd.notna(median) and median > 1e8:
+        return pd.to_datetime(numbers, unit='s', errors='coerce')
+    return EXCEL_EPOCH + pd.to_timedelta(numbers, unit='D')
+
+
+def to_local_wall_clock(values):
+    # 시간대 정보가 있는 시각은 한국 현지 시각으로 바꾼 뒤 시간대를 뗀다 (DatetimeIndex 반환)
+    # '2024-07-01T14:00:00+09:00'이나 UTC로 저장된 Parquet도 14시로 계산되도록
+    index = pd.DatetimeIndex(values)
+    if index.tz is not None:
+        index = index.tz_convert(LOCAL_TZ).tz_localize(None)
+    return index
+
+
+def _as_local(values):
+    if getattr(values.dt, 'tz', None) is None:
+        return values
+    return pd.Series(to_local_wall_clock(values), index=values.index, name=values.name)
+
+
+def _to_datetime_local(values, **kwargs):
+    # 시간대가 서로 다른 문자열이 섞이면 UTC로 맞춘 뒤 현지 시각으로
+    try:
+        parsed = pd.to_datetime(values, errors='coerce', **kwargs)
+    except ValueError:
+        parsed = pd.to_datetime(values, errors='coerce', utc=True, **kwargs)
+    return _as_local(parsed)
+
+
+def _localize_ampm(text):
+    return text.str.replace('오전', 'AM', regex=False).str.replace('오후', 'PM', regex=False)
+
+
+@lru_cache(maxsize=64)
+def _best_format(sample):
+    sample = pd.Series(sample, dtype=object)
+    best, best_ratio = None, 0.0
+    for fmt in DATETIME_FORMATS:
+        ratio = pd.to_datetime(sample, format=fmt, errors='coerce').notna().mean()
+        if ratio > best_ratio:
+            best, best_ratio = fmt, ratio
+        if ratio == 1.0:
+            break
+    return best if best_ratio >= 0.9 else None
+
+
+def sniff_datetime_format(values):
+    # 앞쪽 문자열 샘플로 날짜 형식을 추정. 찾지 못하면 None (pandas 추론으로 처리)
+    sample = values.dropna().head(SNIFF_SAMPLE_ROWS)
+    text = sample[sample.map(type) == str]
+    if text.empty:
+        return None
+    return _best_format(tuple(_localize_ampm(text.str.strip())))
+
+
+def _parse_text(text, fmt):
+    text = _localize_ampm(text.str.strip())
+    if fmt is None:
+        return _to_datetime_local(text, format='mixed')
+    parsed = pd.to_datetime(text, format=fmt, errors='coerce')
+    failed = parsed.isna() & text.ne('')
+    if failed.any():
+        # 형식이 다른 일부 행만 느린 추론으로 다시 시도
+        parsed[failed] = _to_datetime_local(text[failed], format='mixed')
+    return parsed
+
+
+def parse_datetimes(values, fmt=None):
+    # 날짜 컬럼 파싱. fmt는 sniff_datetime_format 결과 (청크마다 다시 추정하지 않도록 재사용)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return _as_local(values)
+    if pd.api.types.is_numeric_dtype(values):
+        return excel_serial_to_datetime(values)
+
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind == 'string':
+        return _parse_text(values, fmt)
+    if kind in ('datetime', 'datetime64', 'date'):
+        return _to_datetime_local(values)
+
+    # 문자열/숫자/날짜 객체가 섞인 컬럼 (엑셀에서 흔함)
+    result = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    types = values.map(type)
+    is_text = types == str
+    is_number = types.isin([int, float, np.int64, np.float64]) & values.notna()
+    is_other = ~is_text & ~is_number & values.notna()
+    if is_text.any():
+        result[is_text] = _parse_text(values[is_text], fmt)
+    if is_number.any():
+        result[is_number] = excel_serial_to_datetime(values[is_number])
+    if is_other.any():
+        result[is_other] = _to_datetime_local(values[is_other])
+    return result
@@ -0,0 +1,238 @@
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cost_core import KR_HOLIDAYS, BANDS_PER_VERSION, StageLog, iter_clean_chunks, decompose_band_minutes
+
+# ---------------------------------------------------------
+# 누적 세션 저장소 (STORE_ROOT 아래 폴더 하나 = 충전소 하나, 업로드마다 Parquet 파일 하나)
+# 매달 누적 이력 파일을 다시 올려도, 처음 보는 세션만 저장/구간 분해한다.
+# 요금은 저장하지 않고 구간별 체류 분(band minutes)만 저장 -> 요금표를 바꿔도 행렬 곱 한 번으로 재계산
+#   충전소/_manifest.json      업로드 이력 + 구간 분해에 쓴 공휴일/개정일 + 판매단가 유무
+#   충전소/part-00001.parquet  key, 시작, 종료, 충전량, 판매단가, b0..b(9*버전-1)
+#   충전소/_lock               쓰는 동안만 존재 (여러 사용자가 같은 충전소에 동시에 추가하는 경우)
+# ---------------------------------------------------------
+STORE_ROOT = 'session_store'
+DEFAULT_STATION = '기본'
+MANIFEST_NAME = '_manifest.json'
+LOCK_NAME = '_lock'
+LOCK_TIMEOUT_SECONDS = 300
+LOCK_STALE_SECONDS = 60 * 60 # 비정상 종료로 남은 잠금 파일은 이 시간이 지나면 무시
+LOCK_POLL_SECONDS = 0.2
+_STATION_PATTERN = re.compile(r'\w[\w .-]{0,63}') # 글자/숫자로 시작, 경로 구분자 없음
+
+
+def station_dir(station, root=STORE_ROOT):
+    # 화면에서 입력한 충전소 이름 -> STORE_ROOT 아래 폴더. 다른 경로로 빠져나가는 이름은 거부
+    station = str(station).strip()
+    if not _STATION_PATTERN.fullmatch(station):
+        raise ValueError("충전소 이름은 글자/숫자로 시작하고 글자, 숫자, 공백, '.', '-', '_'만 쓸 수 있습니다 (64자 이내).")
+    return Path(root) / station
+
+
+def list_stations(root=STORE_ROOT):
+    root = Path(root)
+    if not root.is_dir():
+        return []
+    return sorted(p.name for p in root.iterdir() if (p / MANIFEST_NAME).exists())
+
+
+def session_keys(sessions):
+    # 시작/종료/충전량이 같으면 같은 세션
+    frame = pd.DataFrame({
+        'start': sessions['분석_시작'].to_numpy('datetime64[ns]').view(np.int64),
+        'end': sessions['분석_종료'].to_numpy('datetime64[ns]').view(np.int64),
+        'kwh': np.round(sessions['분석_충전량'].to_numpy(float), 6),
+    })
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+
+def calendar_signature(holidays, version_dates):
+    return [sorted(holidays), sorted(version_dates)]
+
+
+def _write_atomic(path, write):
+    # 중간에 실패해도 기존 파일이 깨지지 않도록 임시 파일에 쓴 뒤 교체
+    tmp = path.with_name(path.name + '.tmp')
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def read_manifest(store_dir):
+    path = Path(store_dir) / MANIFEST_NAME
+    if not path.exists():
+        return {'uploads': [], 'calendar': None, 'next_part': 1}
+    return json.loads(path.read_text(encoding='utf-8'))
+
+
+def store_version(store_dir):
+    # 저장소 내용이 바뀌었는지 비교하는 값 (업로드가 추가될 때마다 증가)
+    return len(read_manifest(store_dir)['uploads'])
+
+
+def _write_manifest(store_dir, manifest):
+    text = json.dumps(manifest, ensure_ascii=False, indent=1)
+    _write_atomic(Path(store_dir) / MANIFEST_NAME, lambda p: p.write_text(text, encoding='utf-8'))
+
+
+@contextmanager
+def _store_lock(store_dir):
+    # 저장소 쓰기 잠금. 부품 번호(next_part)와 매니페스트를 읽고 쓰는 동안 다른 작업이 끼어들지 않도록
+    path = Path(store_dir) / LOCK_NAME
+    deadline = time.monotonic() + LOCK_TIMEOUT_SECONDS
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - path.stat().st_mtime > LOCK_STALE_SECONDS:
+                    path.unlink(missing_ok=True)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError("다른 사용자가 같은 충전소 저장소에 쓰는 중입니다. 잠시 후 다시 시도하세요.")
+            time.sleep(LOCK_POLL_SECONDS)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        path.unlink(missing_ok=True)
+
+
+def _part_paths(store_dir):
+    return sorted(Path(store_dir).glob('part-*.parquet'))
+
+
+def _band_frame(starts, ends, holidays, version_dates):
+    band_minutes = decompose_band_minutes(starts, ends, holidays, version_dates)
+    return pd.DataFrame(band_minutes, columns=[f'b{c}' for c in range(band_minutes.shape[1])])
+
+
+def _sync_calendar(store_dir, manifest, holidays, version_dates):
+    # 공휴일/개정일이 바뀌었으면 저장된 세션을 다시 분해해 파일별로 교체 (원본 파일은 다시 읽지 않음)
+    signature = calendar_signature(holidays, version_dates)
+    if manifest['calendar'] == signature:
+        return
+    for path in _part_paths(store_dir):
+        part = pd.read_parquet(path, columns=['key', '분석_시작', '분석_종료', '분석_충전량', '분석_판매단가'])
+        part = pd.concat([part, _band_frame(part['분석_시작'], part['분석_종료'], holidays, version_dates)], axis=1)
+        _write_atomic(path, lambda p: part.to_parquet(p, index=False))
+    manifest['calendar'] = signature
+    _write_manifest(store_dir, manifest)
+
+
+def _store_has_price(store_dir, manifest):
+    # 저장소 세션에 판매단가가 있는지 (빈 저장소면 None). 예전 매니페스트는 저장된 값으로 판단
+    if manifest.get('has_price') is not None:
+        return manifest['has_price']
+    paths = _part_paths(store_dir)
+    if not paths:
+        return None
+    return bool(pd.read_parquet(paths[0], columns=['분석_판매단가'])['분석_판매단가'].notna().any())
+
+
+def add_file(store_dir, data, name, digest, start_col, end_col, kwh_col, price_col,
+             holidays=KR_HOLIDAYS, version_dates=(), progress=None, stages=None):
+    # 업로드 파일에서 처음 보는 세션만 저장. 반환: (파일 세션 수, 새 세션 수)
+    # 이미 넣은 파일(같은 내용 해시)은 읽지 않는다. 최소 시간/충전량 필터는 불러올 때 적용
+    stages = stages if stages is not None else StageLog()
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    with _store_lock(store_dir):
+        manifest = read_manifest(store_dir)
+        # 판매단가가 있는 업로드와 없는 업로드가 섞이면 없는 쪽 매출이 빠지므로 막는다
+        # (이미 넣은 파일을 다른 설정으로 다시 분석하는 경우도 여기서 걸러야 불러온 세션과 설정이 어긋나지 않음)
+        has_price = price_col is not None
+        stored_price = _store_has_price(store_dir, manifest)
+        if stored_price is not None and stored_price != has_price:
+            raise ValueError(
+                f"이 충전소 저장소는 판매단가 컬럼이 {'있는' if stored_price else '없는'} 파일로 쌓여 있습니다. "
+                f"'엑셀 판매단가 사용'을 {'켜고' if stored_price else '끄고'} 올리거나 다른 충전소 이름을 쓰세요."
+            )
+        for upload in manifest['uploads']:
+            if upload['digest'] == digest:
+                return upload['rows'], 0
+        manifest['has_price'] = has_price
+        _sync_calendar(store_dir, manifest, holidays, version_dates)
+
+        known = [pd.read_parquet(p, columns=['key'])['key'].to_numpy() for p in _part_paths(store_dir)]
+        known = np.concatenate(known) if known else np.zeros(0, dtype=np.uint64)
+        n_rows = 0
+        new_parts = []
+        for part in iter_clean_chunks(data, name, start_col, end_col, kwh_col, price_col, 0, 0, progress, stages):
+            keys = session_keys(part)
+            n_rows += len(part)
+            # 저장소에 이미 있거나, 같은 파일 안에서 중복된 세션은 건너뜀
+            new = ~np.isin(keys, known) & ~pd.Series(keys).duplicated().to_numpy()
+            if not new.any():
+                continue
+            part = part[new].reset_index(drop=True)
+            stored = pd.DataFrame({
+                'key': keys[new],
+                '분석_시작': part['분석_시작'].astype('datetime64[ns]'),
+                '분석_종료': part['분석_종료'].astype('datetime64[ns]'),
+                '분석_충전량': part['분석_충전량'],
+                '분석_판매단가': part['분석_판매단가'] if price_col is not None else np.nan,
+            })
+            with stages.stage('구간 분해', rows=len(part)):
+                new_parts.append(pd.concat([stored, _band_frame(part['분석_시작'], part['분석_종료'], holidays, version_dates)], axis=1))
+            known = np.concatenate([known, keys[new]])
+
+        n_new = sum(len(p) for p in new_parts)
+        if new_parts:
+            path = store_dir / f"part-{manifest['next_part']:05d}.parquet"
+            new_sessions = pd.concat(new_parts, ignore_index=True)
+            with stages.stage('저장소 쓰기', rows=len(new_sessions)):
+                _write_atomic(path, lambda p: new_sessions.to_parquet(p, index=False))
+            manifest['next_part'] += 1
+        manifest['uploads'].append({
+            'digest': digest, 'name': name, 'rows': n_rows, 'new_rows': n_new,
+            'added_at': datetime.now().isoformat(timespec='seconds'),
+        })
+        _write_manifest(store_dir, manifest)
+        return n_rows, n_new
+
+
+def load_store(store_dir, min_minutes, min_kwh, holidays=KR_HOLIDAYS, version_dates=(), stages=None):
+    # 저장된 세션 전체를 load_sessions와 같은 형태 (세션, 분해 행렬)로 반환
+    stages = stages if stages is not None else StageLog()
+    paths = _part_paths(store_dir)
+    n_codes = (len(version_dates) + 1) * BANDS_PER_VERSION
+    if not paths:
+        empty = pd.DataFrame({'분석_시작': pd.Series(dtype='datetime64[ns]'), '분석_종료': pd.Series(dtype='datetime64[ns]'),
+                              '분석_충전량': pd.Series(dtype=float), '충전시간(분)': pd.Series(dtype=np.float32)})
+        return empty, np.zeros((0, n_codes), dtype=np.int32)
+    with stages.stage('저장소 구간 재분해'), _store_lock(store_dir):
+        _sync_calendar(store_dir, read_manifest(store_dir), holidays, version_dates)
+
+    with stages.stage('저장소 불러오기') as info:
+        stored = pd.concat([pd.read_parquet(p) for p in paths], ignore_index=True)
+        info['rows'] = len(stored)
+    band_cols = [f'b{c}' for c in range(n_codes)]
+    band_minutes = stored[band_cols].to_numpy(np.int32)
+    sessions = stored[['분석_시작', '분석_종료', '분석_충전량']].copy()
+    sessions['충전시간(분)'] = ((sessions['분석_종료'] - sessions['분석_시작']).dt.total_seconds() / 60).astype(np.float32)
+    has_price = stored['분석_판매단가'].notna()
+    if has_price.any() and not has_price.all():
+        raise ValueError("저장소에 판매단가가 있는 세션과 없는 세션이 섞여 있습니다. 판매단가 기준을 맞춰 충전소 저장소를 다시 만드세요.")
+    if has_price.any():
+        sessions['분석_판매단가'] = stored['분석_판매단가']
+
+    keep = ((sessions['충전시간(분)'] >= min_minutes) & (sessions['분석_충전량'] >= min_kwh)).to_numpy()
+    return sessions[keep].reset_index(drop=True), band_minutes[keep]
+
+
+def store_uploads(store_dir):
+    # 저장소에 넣은 파일 이력 (화면 표시용)
+    uploads = pd.DataFrame(read_manifest(store_dir)['uploads'], columns=['name', 'rows', 'new_rows', 'added_at'])
+    return uploads.rename(columns={'name': '파일', 'rows': '세션수', 'new_rows': '신규', 'added_at': '추가시각'})
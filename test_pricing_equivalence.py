@@ -0,0 +1,13 @@
+import pytest
+
+from bench_cost import run_equivalence_check
+
+# 빠른 요금 엔진(segment/batch/구간 분해/부하 이동)과 파일 입력 경로(ingest + preprocess + load_sessions)가
+# 기준 엔진 calculate_tou_cost_photo와 같은 요금을 내는지. 시간대 있는 시각과 여러 날짜 문자열 형식 포함
+# (python bench_cost.py check와 같은 검사)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_fast_engines_match_reference(seed):
+    failures = run_equivalence_check(cases=200, seed=seed)
+    assert failures == [], '\n'.join(failures)
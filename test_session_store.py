@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+import session_store
+from bench_cost import make_sessions
+from cost_core import file_digest
+
+# 누적 저장소: 같은 파일 다시 올리기, 겹치는 누적 파일, 판매단가 유무가 섞이는 경우
+COLS = ('충전시작일시', '충전종료일시', '충전량(kWh)')
+
+
+def csv_bytes(frame):
+    return frame.to_csv(index=False).encode('utf-8')
+
+
+def add(store_dir, data, price_col='판매단가'):
+    return session_store.add_file(store_dir, data, 'upload.csv', file_digest(data), *COLS, price_col)
+
+
+def test_reupload_adds_nothing(tmp_path):
+    data = csv_bytes(make_sessions(300, seed=1))
+    assert add(tmp_path, data) == (300, 300)
+    assert add(tmp_path, data) == (300, 0)
+    assert session_store.store_version(tmp_path) == 1
+    sessions, band_minutes = session_store.load_store(tmp_path, 0, 0)
+    assert len(sessions) == len(band_minutes) == 300
+    assert '분석_판매단가' in sessions
+
+
+def test_cumulative_upload_stores_only_new_sessions(tmp_path):
+    frame = make_sessions(400, seed=2)
+    assert add(tmp_path, csv_bytes(frame.iloc[:250])) == (250, 250)
+    assert add(tmp_path, csv_bytes(frame.iloc[100:])) == (300, 150)
+    sessions, _ = session_store.load_store(tmp_path, 0, 0)
+    assert len(sessions) == 400
+    expected = pd.to_datetime(frame['충전시작일시']).sort_values().to_numpy('datetime64[ns]')
+    assert (sessions['분석_시작'].sort_values().to_numpy('datetime64[ns]') == expected).all()
+
+
+@pytest.mark.parametrize('first_price, second_price', [('판매단가', None), (None, '판매단가')])
+def test_price_mismatch_is_refused(tmp_path, first_price, second_price):
+    frame = make_sessions(200, seed=3)
+    data = csv_bytes(frame)
+    add(tmp_path, data, first_price)
+    # 새 파일도, 이미 넣은 파일을 다른 설정으로 다시 올리는 것도 거부
+    with pytest.raises(ValueError, match='판매단가'):
+        add(tmp_path, csv_bytes(make_sessions(50, seed=4)), second_price)
+    with pytest.raises(ValueError, match='판매단가'):
+        add(tmp_path, data, second_price)
+    assert session_store.store_version(tmp_path) == 1
+
+
+def test_load_store_refuses_mixed_prices(tmp_path):
+    add(tmp_path, csv_bytes(make_sessions(100, seed=5)), '판매단가')
+    # 판매단가 유무를 기록하기 전에 만들어진 저장소에 없는 쪽 업로드가 섞인 경우
+    manifest = session_store.read_manifest(tmp_path)
+    manifest['has_price'] = False
+    session_store._write_manifest(tmp_path, manifest)
+    add(tmp_path, csv_bytes(make_sessions(100, seed=6)), None)
+    with pytest.raises(ValueError, match='섞여'):
+        session_store.load_store(tmp_path, 0, 0)